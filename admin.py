@@ -1,7 +1,7 @@
 """Admin site setup for common_models"""
 
 from typing import Iterable, Optional, Sequence
-from django.contrib import admin
+from django.contrib import admin, messages
 
 
 from .models import BooleanSetting, ChannelTag, DiscordChannel, DiscordOverwrite, DiscordRole, \
@@ -11,7 +11,8 @@ from .models import BooleanSetting, ChannelTag, DiscordChannel, DiscordOverwrite
     InclusivityPage, FacilShift, FacilShiftSignup, RoleInvite, \
     Setting, LockoutPeriod, FAQPage, QRCode, RoleOption, SiteImage, SiteSVG, TeamRoom, Event, \
     Calendar, CalendarRelation, EventRelation, Pronoun, PronounOption, DiscordMessage, \
-    RandallBooking, RandallBlocked, RandallLocation, SponsorLogo
+    RandallBooking, RandallBlocked, RandallLocation, SponsorLogo, DiscordOutboxMessage, PuzzleGuessStats, \
+    PuzzleWrongAnswer, CoinTransaction
 
 
 class RandallBookingAdmin(admin.ModelAdmin):
@@ -49,6 +50,14 @@ class DiscordMessageAdmin(admin.ModelAdmin):
 admin.site.register(DiscordMessage, DiscordMessageAdmin)
 
 
+class DiscordOutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ("channel", "created_at", "sent_at", "attempts", "failed")
+    list_filter = ("failed",)
+
+
+admin.site.register(DiscordOutboxMessage, DiscordOutboxMessageAdmin)
+
+
 class PronounAdmin(admin.ModelAdmin):
     list_display = ("name", "order", "user")
 
@@ -372,7 +381,7 @@ class TeamPuzzleActivityAdmin(admin.ModelAdmin):
     def activity_is_verified(self, obj) -> bool:
         return obj.is_verified
 
-    readonly_fields: Sequence[str] = ('puzzle_start_at', "activity_is_active",
+    readonly_fields: Sequence[str] = ('puzzle_start_at', "puzzle_unlocked_at", "activity_is_active",
                                       "activity_is_completed", "activity_is_verified")
     list_display = ("team", "puzzle", "activity_is_active", "activity_is_completed", "activity_is_verified",
                     "puzzle_start_at", "puzzle_completed_at")
@@ -385,6 +394,13 @@ admin.site.register(TeamPuzzleActivity, TeamPuzzleActivityAdmin)
 class VerificationPhotoAdmin(admin.ModelAdmin):
 
     list_display = ("pk", "datetime", "approved")
+    list_filter = ("approved",)
+    actions = ("approve_photos",)
+
+    @admin.action(description="Approve selected photos")
+    def approve_photos(self, request, queryset):
+        num_approved = VerificationPhoto.approve_many(queryset)
+        self.message_user(request, f"Approved {num_approved} photo(s).")
 
 
 admin.site.register(VerificationPhoto, VerificationPhotoAdmin)
@@ -392,12 +408,43 @@ admin.site.register(VerificationPhoto, VerificationPhotoAdmin)
 
 class PuzzleGuessAdmin(admin.ModelAdmin):
 
-    list_display = ("activity", "datetime", "value")
+    list_display = ("activity", "datetime", "value", "correct")
 
 
 admin.site.register(PuzzleGuess, PuzzleGuessAdmin)
 
 
+class PuzzleGuessStatsAdmin(admin.ModelAdmin):
+    """Admin for the guess statistics of puzzles, the most guessed wrong first."""
+
+    list_display = ("puzzle", "guesses", "wrong_guesses", "solves", "mean_solve_seconds")
+    # Read from the solve time histogram, a query per puzzle, so only on the puzzle's page
+    readonly_fields = ("median_solve_seconds",)
+    ordering = ("-wrong_guesses",)
+    actions = ["rebuild_guess_stats"]
+
+    @admin.display(description="Median solve seconds")
+    def median_solve_seconds(self, obj: PuzzleGuessStats) -> Optional[int]:
+        return obj.solve_time_percentiles((0.5,))[0.5]
+
+    @admin.action(description="Rebuild the guess statistics of every puzzle")
+    def rebuild_guess_stats(self, request, queryset):
+        PuzzleGuessStats.rebuild()
+
+
+admin.site.register(PuzzleGuessStats, PuzzleGuessStatsAdmin)
+
+
+class PuzzleWrongAnswerAdmin(admin.ModelAdmin):
+
+    list_display = ("puzzle", "value", "count")
+    list_filter = ("puzzle",)
+    ordering = ("puzzle", "-count")
+
+
+admin.site.register(PuzzleWrongAnswer, PuzzleWrongAnswerAdmin)
+
+
 class TeamAdmin(admin.ModelAdmin):
     """Admin for teams."""
 
@@ -407,12 +454,17 @@ class TeamAdmin(admin.ModelAdmin):
     actions = [
         "reset_team_scavenger_progress",
         "refresh_team_scavenger_progress",
+        "rebuild_team_solve_counters",
+        "check_teams_finished_scavenger",
+        "reconcile_coins",
         "enable_scavenger_for_team",
         "disable_scavenger_for_team",
         "enable_trade_up_for_team",
         "disable_trade_up_for_team"
     ]
     ordering: Optional[Sequence[str]] = ("scavenger_team",)
+    # Team.save does not write them, edits to them would be lost
+    readonly_fields = Team.SQL_MAINTAINED_FIELDS
 
     @admin.display(boolean=True, description="Scavenger Enabled for Team")
     def scavenger_enabled_for_team(self, obj: Team) -> bool:
@@ -420,9 +472,7 @@ class TeamAdmin(admin.ModelAdmin):
 
     @admin.action(description="Reset team scavenger progress")
     def reset_team_scavenger_progress(self, request, queryset):
-
-        for obj in queryset:
-            obj.reset_scavenger_progress()
+        Team.reset_all_scavenger_progress(queryset)
 
     @admin.action(description="Refresh team scavenger progress")
     def refresh_team_scavenger_progress(self, request, queryset: Iterable[Team]):
@@ -430,6 +480,20 @@ class TeamAdmin(admin.ModelAdmin):
         for obj in queryset:
             obj.refresh_scavenger_progress()
 
+    @admin.action(description="Rebuild team scavenger solve counters")
+    def rebuild_team_solve_counters(self, request, queryset):
+        Team.rebuild_solve_counters(queryset)
+
+    @admin.action(description="Check whether the teams finished scavenger")
+    def check_teams_finished_scavenger(self, request, queryset):
+        num_finished = Team.check_all_finished_scavenger(queryset)
+        self.message_user(request, f"{num_finished} more team(s) finished scavenger.")
+
+    @admin.action(description="Reconcile the team coins with the ledger")
+    def reconcile_coins(self, request, queryset):
+        mismatched = CoinTransaction.reconcile(queryset, fix=True)
+        self.message_user(request, f"Corrected the coins of {len(mismatched)} team(s).")
+
     @admin.action(description="Enable scavenger for the team")
     def enable_scavenger_for_team(self, request, queryset: Iterable[Team]):
 
@@ -455,11 +519,39 @@ class TeamAdmin(admin.ModelAdmin):
             obj.disable_trade_up_for_team()
 
 
+class CoinTransactionAdmin(admin.ModelAdmin):
+    """Admin for the coin ledger, adding a transaction awards its coins and transactions are never changed."""
+
+    list_display = ("team", "amount", "reason", "created_by", "created_at")
+    list_filter = ("team",)
+    ordering = ("-created_at",)
+    fields = ("team", "amount", "reason")
+
+    def save_model(self, request, obj: CoinTransaction, form, change) -> None:
+        saved = CoinTransaction.award(obj.team_id, obj.amount, obj.reason, request.user)
+        obj.pk = saved.pk
+
+    def has_change_permission(self, request, obj=None) -> bool:
+        return False
+
+    def has_delete_permission(self, request, obj=None) -> bool:
+        return False
+
+
+admin.site.register(CoinTransaction, CoinTransactionAdmin)
+
+
 class MagicLinkAdmin(admin.ModelAdmin):
     """Admin for Magic Links."""
 
     list_display = ('user', 'expiry', 'delete_immediately')
 
+    def save_model(self, request, obj: MagicLink, form, change) -> None:
+        super().save_model(request, obj, form, change)
+        if not change:
+            # Only the digest is stored, this is the one time the link can be shown
+            self.message_user(request, f"The link, shown only this once: {obj.full_link()}", messages.WARNING)
+
 
 admin.site.register(Puzzle, PuzzleAdmin)
 admin.site.register(Team, TeamAdmin)
@@ -1,7 +1,16 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class CommonModelsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'common_models'
     verbose_name = 'Common Models'
+
+    def ready(self):
+        post_migrate.connect(_seed_settings, sender=self)
+
+
+def _seed_settings(sender, **kwargs):
+    from common_models.site_settings import seed_settings
+    seed_settings()
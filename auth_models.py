@@ -1,23 +1,27 @@
 from django.db import models
+from django.db.models import Q
 from django.contrib.auth.models import User
 from django.conf import settings
-from typing import Optional
+from typing import Callable, Optional
 import datetime
+import hashlib
 from django.utils import timezone
-import qrcode
-import qrcode.constants
 import logging
-from io import BytesIO
 from django.utils.encoding import iri_to_uri
-from django.core.files import File
+from django.core.files.base import ContentFile
 import common_models.models as md
-from PIL import Image, ImageDraw, ImageFont
+from common_models.qr_render import QRStyle, render_many, render_png
 
 logger = logging.getLogger("common_models.auth_models")
 
 
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
 class MagicLink(models.Model):
-    token = models.CharField(max_length=64, default=md.random_token)
+    # Only the digest of the token is stored, the token itself is known when the link is issued
+    token = models.CharField(max_length=64, unique=True, editable=False)
     user = models.OneToOneField(User, models.CASCADE)
     expiry = models.DateTimeField(default=md.days5)
     delete_immediately = models.BooleanField(default=True)
@@ -33,6 +37,58 @@ class MagicLink(models.Model):
             ("view_links", "Can view magic links"),
         ]
 
+    # The token itself, only known when the link is issued or reissued, never for a link loaded from the database
+    raw_token: Optional[str] = None
+
+    def save(self, *args, **kwargs) -> None:
+        if not self.token:
+            self.reissue(save=False)
+        super().save(*args, **kwargs)
+
+    def reissue(self, save: bool = True) -> str:
+        """
+        Gives the link a new token and returns it, the old token, its full link and its QR code stop working.
+
+        The QR code is left as it is, _generate_qr_code renders the new one.
+        """
+
+        self.raw_token = md.random_token()
+        self.token = hash_token(self.raw_token)
+        if save and not self._state.adding:
+            self.save(update_fields=["token"])
+        return self.raw_token
+
+    @staticmethod
+    def from_token(token: str) -> Optional["MagicLink"]:
+        """
+        The unexpired link with the token, found with one indexed lookup, None if there is none.
+
+        The lookup is by digest, so its timing can only reveal digests, which give nothing away about the tokens.
+        """
+
+        return MagicLink.objects.select_related("user") \
+            .filter(token=hash_token(token), expiry__gt=timezone.now()).first()
+
+    @staticmethod
+    def sweep_expired(batch_size: int = 500) -> int:
+        """Deletes the expired links and their QR codes a batch at a time, returns the number deleted."""
+
+        storage = MagicLink._meta.get_field("qr_code").storage
+        deleted = 0
+        while True:
+            batch = list(MagicLink.objects.filter(expiry__lte=timezone.now())
+                         .order_by("pk").values_list("pk", "qr_code")[:batch_size])
+            if not batch:
+                break
+            MagicLink.objects.filter(pk__in=[pk for pk, _ in batch]).delete()
+            for _, name in batch:
+                if name:
+                    storage.delete(name)
+            deleted += len(batch)
+
+        logger.info(f"Deleted {deleted} expired magic links")
+        return deleted
+
     def link_used(self) -> bool:
         """Returns True if link can still be used, or False if not."""
         if self.delete_immediately:
@@ -70,35 +126,69 @@ class MagicLink(models.Model):
             # TODO clean this up to make it better
             hostname_s = "http://" + hostname_s
 
-        return f"{hostname_s}{login_path}?auth={self.token}{redirect_str}"
+        if self.raw_token is None:
+            raise ValueError("The token of a magic link is only known when it is issued, reissue() gives it a new one")
+
+        return f"{hostname_s}{login_path}?auth={self.raw_token}{redirect_str}"
+
+    @staticmethod
+    def style() -> QRStyle:
+        return QRStyle(font_path=settings.STATICFILES_DIRS[0] + "/font.ttf")
+
+    @property
+    def qr_label(self) -> str:
+        return self.user.first_name + " " + self.user.last_name
 
     def _generate_qr_code(
             self, hostname: Optional[str] = None, login_path: Optional[str] = None,
             redirect: Optional[str] = None) -> None:
-
-        qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_H)
-        qr.add_data(self.full_link(hostname=hostname, login_path=login_path, redirect=redirect))
-        qr.make(fit=True)
-
-        blob = BytesIO()
-        img = qr.make_image()
-
-        orig_width = img.size[0]
-        height = img.size[1]
-        font = ImageFont.truetype(settings.STATICFILES_DIRS[0]+"/font.ttf", 40)
-        name = self.user.first_name + " " + self.user.last_name
-        text_len = font.getlength(name)
-        width = int(max(orig_width, text_len + 50))
-        offset = 0
-        if text_len + 50 > orig_width:
-            offset = int((text_len + 50 - orig_width)/2)
-        with_text = Image.new(mode="RGB", size=(width, height + 50))
-        draw = ImageDraw.Draw(with_text)
-        draw.rectangle([(0, 0), with_text.size], fill=(255, 255, 255))
-        with_text.paste(img._img, (offset, 0))
-        draw.text((width/2-text_len/2, height - 30),
-                  name, align="center", fill=(0, 0, 0), font=font)
-
-        with_text.save(blob, "PNG")
-        self.qr_code.save("QRCode.png", File(blob))
-        self.save()
+        """Renders and saves the QR code of the link, which needs its token so raises ValueError if it is unknown."""
+
+        png = render_png(self.full_link(hostname=hostname, login_path=login_path, redirect=redirect),
+                         self.qr_label, MagicLink.style())
+        self.qr_code.save("QRCode.png", ContentFile(png))
+
+    @staticmethod
+    def issue_many(
+            users: models.QuerySet, hostname: Optional[str] = None, login_path: Optional[str] = None,
+            redirect: Optional[str] = None, workers: Optional[int] = None, batch_size: int = 500,
+            progress: Optional[Callable[[int, int], None]] = None) -> int:
+        """
+        Gives each of the users a magic link with a QR code, returns the number of links completed.
+
+        Links that were created without a QR code, by an earlier run that was interrupted, get a new token as only
+        the digest of their token was stored.
+
+        Users are done a batch at a time: the missing links are created with one insert, their QR codes rendered in
+        a process pool (see qr_render.render_many) and stored with one update. Users whose link already has a QR
+        code are skipped and every statement commits on its own, so running it again after an interruption carries
+        on where it stopped. progress is called with the number of links completed and the total after each batch.
+        """
+
+        user_ids = list(users.filter(Q(magiclink=None) | Q(magiclink__qr_code=""))
+                        .order_by("pk").values_list("pk", flat=True).distinct())
+        style = MagicLink.style()
+
+        done = 0
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            new_links = [MagicLink(user_id=u) for u in batch]
+            for link in new_links:
+                link.reissue(save=False)
+            MagicLink.objects.bulk_create(new_links, ignore_conflicts=True)
+            links = list(MagicLink.objects.filter(user__in=batch, qr_code="").select_related("user"))
+            for link in links:
+                link.reissue(save=False)
+
+            pngs = render_many([(link.full_link(hostname=hostname, login_path=login_path, redirect=redirect),
+                                 link.qr_label) for link in links], style, workers)
+            for link, png in zip(links, pngs):
+                link.qr_code.save("QRCode.png", ContentFile(png), save=False)
+            MagicLink.objects.bulk_update(links, ["token", "qr_code"])
+
+            done += len(links)
+            if progress is not None:
+                progress(done, len(user_ids))
+
+        logger.info(f"Issued {done} magic links")
+        return done
@@ -0,0 +1,52 @@
+"""
+Compares checking guesses against a puzzle's answers by splitting the answer field every time
+with the cached answer index.
+
+Run from the directory containing common_models: python -m common_models.benchmarks.bench_answer_index
+"""
+
+import timeit
+
+from common_models.scav_answers import answer_index, normalize_answer, set_bits
+
+NUM_GUESSES = 20000
+
+
+def split_check(answer: str, guess: str, bitmask: int) -> int:
+    answers = answer.split(",")
+    for i in range(len(answers)):
+        if guess.lower() == answers[i].lower():
+            bitmask |= 1 << i
+    return bitmask
+
+
+def index_check(answer: str, guess: str, bitmask: int) -> int:
+    return bitmask | answer_index(answer).masks.get(normalize_answer(guess), 0)
+
+
+def split_completed(answer: str, bitmask: int) -> list:
+    answers = answer.split(",")
+    return [answers[i] for i in range(32) if bitmask & 1 << i]
+
+
+def index_completed(answer: str, bitmask: int) -> list:
+    index = answer_index(answer)
+    return [index.answers[i] for i in set_bits(bitmask & index.full_mask)]
+
+
+def main() -> None:
+    for num_answers in (1, 5, 15, 31):
+        answer = ",".join(f"Answer Number {i}" for i in range(num_answers))
+        guess = f"answer number {num_answers - 1}"
+        bitmask = 0b101 & (1 << num_answers) - 1
+
+        results = []
+        for func, args in ((split_check, (answer, guess, bitmask)), (index_check, (answer, guess, bitmask)),
+                           (split_completed, (answer, bitmask)), (index_completed, (answer, bitmask))):
+            seconds = timeit.timeit(lambda: func(*args), number=NUM_GUESSES)
+            results.append(f"{func.__name__} {seconds / NUM_GUESSES * 1e6:.2f}us")
+        print(f"{num_answers:>2} answers: " + ", ".join(results))
+
+
+if __name__ == "__main__":
+    main()
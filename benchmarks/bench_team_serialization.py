@@ -0,0 +1,50 @@
+"""
+Compares serializing every team with Team.to_dict per instance with Team.serialize_many, for 200 teams.
+
+Needs a configured database, the teams are created in a transaction that is rolled back.
+
+Run from the directory containing common_models: python -m common_models.benchmarks.bench_team_serialization
+"""
+
+import timeit
+
+from django.contrib.auth.models import Group
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from common_models.models import Team
+
+NUM_TEAMS = 200
+NUMBER = 20
+
+
+def per_instance() -> list:
+    return [team.to_dict for team in Team.objects.all()]
+
+
+def bulk() -> list:
+    return Team.serialize_many()
+
+
+def bulk_columnar() -> dict:
+    return Team.serialize_many(columnar=True)
+
+
+def main() -> None:
+    with transaction.atomic():
+        groups = Group.objects.bulk_create([Group(name=f"Benchmark Team {i}") for i in range(NUM_TEAMS)])
+        Team.objects.bulk_create([Team(group=g, display_name=g.name, coin_amount=i, color=i * 0x010101)
+                                  for i, g in enumerate(groups)])
+        num_teams = Team.objects.count()
+
+        for func in (per_instance, bulk, bulk_columnar):
+            with CaptureQueriesContext(connection) as queries:
+                func()
+            seconds = timeit.timeit(func, number=NUMBER)
+            print(f"{func.__name__}: {seconds / NUMBER * 1e3:.2f}ms, {len(queries)} queries for {num_teams} teams")
+
+        transaction.set_rollback(True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Write-behind buffers for rows that nothing reads in the request that creates them."""
+
+import atexit
+import logging
+import threading
+import time
+from typing import Callable, Generic, List, Optional, Type, TypeVar
+
+from django.db import connections, models, transaction
+
+logger = logging.getLogger("common_models.buffering")
+
+M = TypeVar("M", bound=models.Model)
+
+
+class WriteBehindBuffer(Generic[M]):
+    """
+    Collects unsaved instances of a model in process memory and inserts them together with bulk_create.
+
+    The buffer is flushed once it holds max_size rows or its oldest row is max_age seconds old, which is checked as
+    rows are added, as requests finish and by a timer thread, so that processes that serve no requests flush too,
+    and when the process exits. A process that dies without exiting cleanly loses the rows it had buffered, never
+    more than max_size. A flush triggered inside a transaction waits for it to commit, so the rows never depend on a
+    transaction that could still roll back. after_insert is called with the rows in the transaction that inserts
+    them, to maintain anything derived from them.
+
+    Rows can refer to rows deleted while they were buffered. before_insert is called with the rows first and
+    returns those still to be inserted, to drop them. A batch that fails to insert is logged and put back to be
+    retried with the next flush, and dropped, with the rows logged, after FLUSH_ATTEMPTS failures in a row. Rows put
+    back that would take the buffer past max_size are dropped and logged, oldest first.
+    """
+
+    FLUSH_ATTEMPTS = 3
+
+    def __init__(self, model: Type[M], max_size: int, max_age: float,
+                 after_insert: Optional[Callable[[List[M]], None]] = None,
+                 before_insert: Optional[Callable[[List[M]], List[M]]] = None) -> None:
+        self.model = model
+        self.max_size = max_size
+        self.max_age = max_age
+        self.after_insert = after_insert
+        self.before_insert = before_insert
+        self._lock = threading.Lock()
+        self._rows: List[M] = []
+        self._oldest: Optional[float] = None
+        self._failures = 0
+        self._timer: Optional[threading.Timer] = None
+        atexit.register(self._flush_at_exit)
+
+    def add(self, row: M) -> None:
+        with self._lock:
+            if not self._rows:
+                self._oldest = time.monotonic()
+            self._rows.append(row)
+            due = self._due()
+            self._start_timer()
+        if due:
+            transaction.on_commit(self.flush)
+
+    def _start_timer(self) -> None:
+        """Starts the timer to flush the buffer once its oldest row is due, unless it is running, under the lock."""
+
+        if self._timer is not None or not self._rows:
+            return
+        self._timer = threading.Timer(max(0.0, self._oldest + self.max_age - time.monotonic()), self._flush_on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _flush_on_timer(self) -> None:
+        with self._lock:
+            self._timer = None
+        try:
+            self.flush_if_due()
+        except Exception:
+            logger.exception(f"Could not flush the buffered {self.model.__name__} rows")
+        finally:
+            # The connections of the timer thread would otherwise stay open
+            connections.close_all()
+        with self._lock:
+            self._start_timer()
+
+    def _due(self) -> bool:
+        return len(self._rows) >= self.max_size or \
+            (bool(self._rows) and time.monotonic() - self._oldest >= self.max_age)
+
+    def flush_if_due(self) -> None:
+        with self._lock:
+            due = self._due()
+        if due:
+            self.flush()
+
+    def flush(self) -> int:
+        """Inserts every buffered row now, returns the number inserted."""
+
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if not rows:
+            return 0
+
+        try:
+            with transaction.atomic():
+                if self.before_insert is not None:
+                    rows = self.before_insert(rows)
+                self.model.objects.bulk_create(rows)
+                if self.after_insert is not None:
+                    self.after_insert(rows)
+        except Exception:
+            self._failed(rows)
+            return 0
+        self._failures = 0
+        return len(rows)
+
+    def _failed(self, rows: List[M]) -> None:
+        self._failures += 1
+        if self._failures >= self.FLUSH_ATTEMPTS:
+            logger.exception(f"Dropping {len(rows)} buffered {self.model.__name__} rows after {self._failures} "
+                             f"failed inserts: {rows!r}")
+            self._failures = 0
+            return
+
+        logger.exception(f"Could not insert {len(rows)} buffered {self.model.__name__} rows, they will be retried")
+        with self._lock:
+            overflow = len(rows) + len(self._rows) - self.max_size
+            if overflow > 0:
+                dropped, rows = rows[:overflow], rows[overflow:]
+                logger.error(f"Dropping {len(dropped)} buffered {self.model.__name__} rows over the buffer's size: "
+                             f"{dropped!r}")
+            self._rows[:0] = rows
+            self._oldest = time.monotonic()
+            self._start_timer()
+
+    def _flush_at_exit(self) -> None:
+        try:
+            self.flush()
+        except Exception:
+            logger.exception(f"Could not flush the buffered {self.model.__name__} rows at exit")
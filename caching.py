@@ -0,0 +1,70 @@
+"""Process local caches of database state, kept in step across processes with a version stamp."""
+
+import threading
+import time
+import uuid
+from typing import Callable, Generic, Optional, Tuple, TypeVar
+
+from django.core.cache import cache
+from django.db import transaction
+
+T = TypeVar("T")
+
+# Copies older than this, in seconds, are rebuilt even if the stamp has not changed
+REFRESH_INTERVAL = 60
+
+
+class VersionedCache(Generic[T]):
+    """
+    Holds a value built from the database in process memory.
+
+    Writers call invalidate(), which stores a new version stamp in the django cache. Readers compare the stamp
+    with the one their copy was built at and rebuild it when they differ, so reads rarely query the database
+    while nothing changes. The django cache needs to be shared (memcached, redis, database) for changes made
+    by one process to be seen by the others straight away. With a per-process cache, like the default
+    LocMemCache, other processes only see them once their copy is refresh_interval seconds old, as copies that
+    old are rebuilt whatever their stamp.
+    """
+
+    def __init__(self, name: str, build: Callable[[], T], refresh_interval: float = REFRESH_INTERVAL) -> None:
+        self.key = f"common_models:version:{name}"
+        self._build = build
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._version: Optional[str] = None
+        self._value: Optional[T] = None
+        self._built_at = 0.0
+
+    def get(self) -> T:
+        return self._current()[1]
+
+    def version(self) -> str:
+        """The stamp of the current value, for keying things derived from it."""
+
+        return self._current()[0]
+
+    def _current(self) -> Tuple[str, T]:
+        version = cache.get(self.key)
+        if version is None:
+            cache.add(self.key, uuid.uuid4().hex, None)
+            version = cache.get(self.key)
+        if version != self._version or self._expired():
+            with self._lock:
+                if version != self._version or self._expired():
+                    self._value = self._build()
+                    self._version = version
+                    self._built_at = time.monotonic()
+        return version, self._value
+
+    def _expired(self) -> bool:
+        return time.monotonic() - self._built_at >= self.refresh_interval
+
+    def invalidate(self) -> None:
+        """Marks every process' copy as stale, now and again once the current transaction commits."""
+
+        self._bump()
+        # A process that rebuilt before the commit would otherwise keep the old state
+        transaction.on_commit(self._bump)
+
+    def _bump(self) -> None:
+        cache.set(self.key, uuid.uuid4().hex, None)
@@ -0,0 +1,241 @@
+"""
+The coin ledger of the teams and their standings.
+
+Every change to a team's coin_amount is recorded as a CoinTransaction and applied to the balance with an F()
+increment in the same transaction, so concurrent awards never overwrite each other and the balance always equals
+the sum of the team's ledger. reconcile checks that it does.
+
+The standings are kept ranked in the django cache and the teams whose coins change are moved within them, rather
+than every team being sorted and serialized for each view of them.
+"""
+
+import logging
+from bisect import bisect_left, insort
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import Case, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.deletion import CASCADE, SET_NULL
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+import common_models.models as md
+
+logger = logging.getLogger("common_models.coin_models")
+
+
+def _ledger_sum() -> Coalesce:
+    """The sum of the ledger of the team in the outer query."""
+
+    totals = CoinTransaction.objects.filter(team=OuterRef("pk")).order_by().values("team") \
+        .annotate(total=Sum("amount")).values("total")
+    return Coalesce(Subquery(totals), Value(0), output_field=models.BigIntegerField())
+
+
+class CoinTransaction(models.Model):
+    """A change to the coin amount of a team, never changed or deleted once made."""
+
+    team = models.ForeignKey("Team", on_delete=CASCADE, related_name="coin_transactions")
+    amount = models.BigIntegerField()
+    reason = models.CharField(max_length=200, blank=True, default="")
+    created_by = models.ForeignKey(User, on_delete=SET_NULL, null=True, blank=True, default=None)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Coin Transaction"
+        verbose_name_plural = "Coin Transactions"
+
+        indexes = [
+            models.Index(fields=["team", "created_at"], name="coin_transaction_team_idx"),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.team}: {self.amount:+} {self.reason}".rstrip()
+
+    @staticmethod
+    def award(team_id: int, amount: int, reason: str = "", user: Optional[User] = None) -> "CoinTransaction":
+        """Adds amount, which may be negative, to the team's coins."""
+
+        with transaction.atomic():
+            entry = CoinTransaction.objects.create(team_id=team_id, amount=amount, reason=reason, created_by=user)
+            md.Team.objects.filter(pk=team_id).update(coin_amount=F("coin_amount") + amount)
+            CoinStandings.teams_changed([team_id])
+        return entry
+
+    @staticmethod
+    def award_many(amounts: Dict[int, int], reason: str = "",
+                   user: Optional[User] = None) -> List["CoinTransaction"]:
+        """
+        Adds the amounts, by team id, to the teams' coins with one insert and one update.
+
+        Zero amounts are skipped.
+        """
+
+        amounts = {team_id: amount for team_id, amount in amounts.items() if amount}
+        if not amounts:
+            return []
+
+        with transaction.atomic():
+            entries = CoinTransaction.objects.bulk_create(
+                [CoinTransaction(team_id=t, amount=a, reason=reason, created_by=user) for t, a in amounts.items()])
+            increment = Case(*[When(pk=t, then=Value(a)) for t, a in amounts.items()],
+                             default=Value(0), output_field=models.BigIntegerField())
+            md.Team.objects.filter(pk__in=amounts).update(coin_amount=F("coin_amount") + increment)
+            CoinStandings.teams_changed(amounts)
+        return entries
+
+    @staticmethod
+    def reconcile(teams: Optional[models.QuerySet] = None, fix: bool = False) -> Dict[int, Tuple[int, int]]:
+        """
+        Finds the teams, all of them by default, whose coin_amount is not the sum of their ledger, in one query.
+
+        Returns their (balance, ledger sum) by team id. With fix their balances are set back to their ledger sums,
+        which are what every award has been recorded in.
+        """
+
+        if teams is None:
+            teams = md.Team.objects.all()
+        mismatched = {
+            team_id: (balance, total)
+            for team_id, balance, total in teams.annotate(ledger=_ledger_sum())
+            .filter(~Q(coin_amount=F("ledger"))).values_list("pk", "coin_amount", "ledger")
+        }
+        for team_id, (balance, total) in mismatched.items():
+            logger.warning(f"Team {team_id} has {balance} coins but its ledger sums to {total}")
+        if fix and mismatched:
+            md.Team.objects.filter(pk__in=mismatched).update(coin_amount=_ledger_sum())
+            CoinStandings.teams_changed(mismatched)
+        return mismatched
+
+
+STANDINGS_KEY = "common_models:coin_standings"
+STANDINGS_GENERATION_KEY = "common_models:coin_standings:generation"
+STANDINGS_LOCK_KEY = "common_models:coin_standings:lock"
+# How long a process may hold the standings to move teams before another may, in seconds
+STANDINGS_LOCK_TIMEOUT = 10
+
+
+def _generation() -> int:
+    generation = cache.get(STANDINGS_GENERATION_KEY)
+    if generation is None:
+        cache.add(STANDINGS_GENERATION_KEY, 0, None)
+        generation = cache.get(STANDINGS_GENERATION_KEY, 0)
+    return generation
+
+
+def _bump_generation() -> int:
+    try:
+        return cache.incr(STANDINGS_GENERATION_KEY)
+    except ValueError:
+        # Evicted, anything stored against the old generation is stale either way
+        cache.add(STANDINGS_GENERATION_KEY, 0, None)
+        return -1
+
+
+class CoinStandings:
+    """
+    Every team ranked by coins, most first, as Team.to_dict dicts.
+
+    Stored in the django cache tagged with a generation, which every change to the teams' coins moves on. Changes
+    move their teams within the stored standings under a short lock, a change that cannot take the lock only moves
+    the generation on, and a reader finding standings of an older generation rebuilds them with one query.
+    """
+
+    def __init__(self, rows: Iterable[Dict[str, Any]], generation: int) -> None:
+        self.generation = generation
+        self._rows: Dict[int, Dict[str, Any]] = {}
+        # (-coins, team id) of every team in ranked order
+        self._order: List[Tuple[int, int]] = []
+        for row in rows:
+            self._rows[row["team_id"]] = row
+            self._order.append((-row["coin_amount"], row["team_id"]))
+        self._order.sort()
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    @staticmethod
+    def current() -> "CoinStandings":
+        generation = _generation()
+        standings = cache.get(STANDINGS_KEY)
+        if standings is None or standings.generation != generation:
+            standings = CoinStandings(md.Team.serialize_many(), generation)
+            cache.set(STANDINGS_KEY, standings, None)
+        return standings
+
+    def top(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """The first limit teams, all by default, each with its rank, tied teams sharing the same rank."""
+
+        result = []
+        for coins, team_id in self._order[:limit]:
+            row = dict(self._rows[team_id])
+            row["rank"] = bisect_left(self._order, (coins,)) + 1
+            result.append(row)
+        return result
+
+    def rank_of(self, team_id: int) -> Optional[int]:
+        """One more than the number of teams with more coins than the team, None if there is no such team."""
+
+        row = self._rows.get(team_id)
+        if row is None:
+            return None
+        return bisect_left(self._order, (-row["coin_amount"],)) + 1
+
+    def row_of(self, team_id: int) -> Optional[Dict[str, Any]]:
+        return self._rows.get(team_id)
+
+    def _remove(self, team_id: int) -> None:
+        row = self._rows.pop(team_id, None)
+        if row is not None:
+            del self._order[bisect_left(self._order, (-row["coin_amount"], team_id))]
+
+    def _put(self, row: Dict[str, Any]) -> None:
+        self._remove(row["team_id"])
+        self._rows[row["team_id"]] = row
+        insort(self._order, (-row["coin_amount"], row["team_id"]))
+
+    @staticmethod
+    def teams_changed(team_ids: Iterable[int]) -> None:
+        """Moves the teams within the standings once the current transaction commits."""
+
+        team_ids = list(team_ids)
+        transaction.on_commit(lambda: CoinStandings._move(team_ids))
+
+    @staticmethod
+    def _move(team_ids: List[int]) -> None:
+        if not cache.add(STANDINGS_LOCK_KEY, 1, STANDINGS_LOCK_TIMEOUT):
+            _bump_generation()
+            return
+        try:
+            generation = _generation()
+            standings = cache.get(STANDINGS_KEY)
+            if standings is None or standings.generation != generation:
+                # Rebuilt by the next reader, with the change
+                _bump_generation()
+                return
+            rows = {row["team_id"]: row for row in md.Team.serialize_many(md.Team.objects.filter(pk__in=team_ids))}
+            for team_id in team_ids:
+                if team_id in rows:
+                    standings._put(rows[team_id])
+                else:
+                    standings._remove(team_id)
+            # Only stored if nothing else changed the teams' coins since the standings were read
+            if _bump_generation() == generation + 1:
+                standings.generation = generation + 1
+                cache.set(STANDINGS_KEY, standings, None)
+        finally:
+            cache.delete(STANDINGS_LOCK_KEY)
+
+    @staticmethod
+    def invalidate() -> None:
+        """Makes the next reader rebuild the standings."""
+
+        _bump_generation()
+
+
+@receiver([post_save, post_delete], sender="common_models.Team")
+def _move_saved_team(sender, instance, **kwargs) -> None:
+    CoinStandings.teams_changed([instance.pk])
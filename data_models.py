@@ -2,6 +2,7 @@ from django.db import models
 from django.db.models.deletion import CASCADE, SET_NULL
 from django.contrib.auth.models import User, Group
 import common_models.models as md
+from common_models import site_settings
 import datetime
 from django.utils.html import escape
 import random
@@ -178,12 +179,9 @@ class FacilShift(models.Model):
         return len(self.signups.all())
 
     def facil_count_on_team(self, team: md.Team) -> int:
-        signups = self.signups.all().select_related("user__details")
-        count = 0
-        for s in signups:
-            if s.user.details.team == team:
-                count += 1
-        return count
+        user_ids = list(self.signups.values_list("user", flat=True))
+        teams = md.Team.for_users(user_ids)
+        return sum(1 for u in user_ids if teams[u] is not None and teams[u].pk == team.pk)
 
     def can_sign_up(self, userdetails):
         if self.administrative:
@@ -204,9 +202,7 @@ class FacilShift(models.Model):
             return True
         if self.signups_start is not None and datetime.datetime.now().timestamp() < self.signups_start.timestamp():
             return True
-        # Defaults to 72h
-        window = int(md.Setting.objects.get_or_create(id="Facil Shift Cutoff",
-                                                      defaults={"value": 259200})[0].value)
+        window = site_settings.FACIL_SHIFT_CUTOFF.get()
         if (self.start - datetime.timedelta(seconds=window)).timestamp() >= datetime.datetime.now().timestamp():
             return False
         return True
@@ -358,17 +354,14 @@ class UserDetails(models.Model):
         if self.checked_in:
             return False
         if role == "Frosh":
-            req = md.Setting.objects.get_or_create(id="Frosh_Checkin_Req",
-                                                   defaults={"value": "waiver"})[0].value.split(",")
+            req = site_settings.FROSH_CHECKIN_REQ.get()
             if "waiver" in req and not self.waiver_completed:
                 return False
             if "wt" in req and not self.wt_waiver_completed:
                 return False
             return True
         else:
-            req = md.Setting.objects.get_or_create(id="Facil_Checkin_Req",
-                                                   defaults={"value": "waiver,brightspace,prc,contract,paid"})[0]
-            req = req.value.split(",")
+            req = site_settings.FACIL_CHECKIN_REQ.get()
             if "waiver" in req and not self.waiver_completed:
                 return False
             if "wt" in req and not self.wt_waiver_completed:
@@ -397,16 +390,13 @@ class UserDetails(models.Model):
         if self.checked_in:
             reason += "Checked-in "
         if role == "Frosh":
-            req = md.Setting.objects.get_or_create(id="Frosh_Checkin_Req",
-                                                   defaults={"value": "waiver"})[0].value.split(",")
+            req = site_settings.FROSH_CHECKIN_REQ.get()
             if "waiver" in req and not self.waiver_completed:
                 reason += "Waiver "
             if "wt" in req and not self.wt_waiver_completed:
                 reason += "WT Waiver "
         else:
-            req = md.Setting.objects.get_or_create(id="Facil_Checkin_Req",
-                                                   defaults={"value": "waiver,brightspace,prc,contract,paid"})[0]
-            req = req.value.split(",")
+            req = site_settings.FACIL_CHECKIN_REQ.get()
             if "waiver" in req and not self.waiver_completed:
                 reason += "Waiver "
             if "wt" in req and not self.wt_waiver_completed:
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from collections import namedtuple
 import pyaccord
 from pyaccord import Client
@@ -6,11 +6,12 @@ from pyaccord.invite import Invite
 from pyaccord.channel import TextChannel
 from pyaccord.guild import Guild
 from pyaccord.permissions import Permissions
-from typing import Iterable, List, Dict, Optional
+from typing import Iterable, List, Dict, Optional, Tuple
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.models.deletion import CASCADE
 from django.conf import settings
 from django.contrib.auth.models import User, Group
+from django.utils import timezone
 import datetime
 import logging
 import common_models.models as md
@@ -23,6 +24,12 @@ except (ModuleNotFoundError, ImportError):
     logger.warn("Could not import GUILD_ID from credentials")
     GUILD_ID = 0
 
+DISCORD_MESSAGE_MAX_LENGTH = 2000
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_MAX_BACKOFF = 300
+# How long a dispatcher has to send the batch it claimed before the messages can be claimed again, in seconds
+OUTBOX_CLAIM_TIMEOUT = 600
+
 
 def get_client() -> Client:
     return Client(settings.DISCORD_BOT_TOKEN, api_version=settings.DEFAULT_DISCORD_API_VERSION)
@@ -389,13 +396,19 @@ class DiscordChannel(models.Model):
 
     @staticmethod
     def send_to_updates_channels(content) -> None:
-        for ch in DiscordChannel.updates_channels():
-            ch.send(content=content)
+        DiscordChannel.queue_to_tag("MANAGEMENT_UPDATES_CHANNEL", content)
 
     @staticmethod
     def send_to_backstage_updates_channels(content) -> None:
-        for ch in DiscordChannel.backstage_updates_channels():
-            ch.send(content=content)
+        DiscordChannel.queue_to_tag("BACKSTAGE_UPDATES_CHANNEL", content)
+
+    @staticmethod
+    def queue_to_tag(tag_name: str, content: str) -> None:
+        """Queues a message to every channel with the tag, it is sent once the current transaction commits."""
+
+        channel_ids = DiscordChannel.objects.filter(tags__name=tag_name).values_list("id", flat=True)
+        DiscordOutboxMessage.objects.bulk_create(
+            [DiscordOutboxMessage(channel_id=channel_id, content=content) for channel_id in channel_ids])
 
     def compute_name(self):
         if self.team is None:
@@ -428,6 +441,11 @@ class DiscordChannel(models.Model):
         api = get_client()
         return api.send_channel_message(self.id, content=content)
 
+    def queue(self, content: str) -> None:
+        """Queues a message to the channel in the outbox instead of sending it right away."""
+
+        DiscordOutboxMessage.objects.create(channel=self, content=content)
+
     def lock(self) -> bool:
         """Lock the channel, only affecting the overwrites in the channel info."""
 
@@ -469,6 +487,112 @@ class DiscordChannel(models.Model):
         return True
 
 
+class DiscordOutboxMessage(models.Model):
+    """Discord message written in the same transaction as the change it reports, sent later by the dispatcher."""
+
+    channel = models.ForeignKey(DiscordChannel, on_delete=CASCADE, related_name="outbox_messages")
+    content = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True, default=None)
+    failed = models.BooleanField(default=False)
+    last_error = models.CharField(max_length=500, blank=True, default="")
+
+    def __str__(self) -> str:
+        return f"Outbox message {self.id} to {self.channel_id}"
+
+    class Meta:
+        """Discord Outbox Message Meta information."""
+
+        verbose_name = "Discord Outbox Message"
+        verbose_name_plural = "Discord Outbox Messages"
+        indexes = [
+            models.Index(fields=["sent_at", "failed", "id"], name="discord_outbox_pending_idx"),
+        ]
+
+    @staticmethod
+    def _chunks(messages: List) -> List[List]:
+        """Groups consecutive messages into chunks that fit in a single discord message."""
+
+        chunks = []
+        length = 0
+        for m in messages:
+            if chunks and length + 1 + len(m.content) <= DISCORD_MESSAGE_MAX_LENGTH:
+                chunks[-1].append(m)
+                length += 1 + len(m.content)
+            else:
+                chunks.append([m])
+                length = len(m.content)
+        return chunks
+
+    @staticmethod
+    def dispatch_pending(batch_size: int = 100) -> Tuple[int, int]:
+        """
+        Sends the oldest pending messages in the outbox, returns (number sent, number failed).
+
+        Messages to a channel are always sent in the order they were queued, consecutive ones being joined
+        into a single discord message when they fit. A message that fails is retried with exponential backoff
+        and holds back the later messages to its channel until it is sent, or dropped after OUTBOX_MAX_ATTEMPTS.
+        Channels waiting on a retry are left out of the batch, so they never hold back the other channels.
+
+        The batch is claimed in a short transaction, by pushing its next attempt OUTBOX_CLAIM_TIMEOUT ahead, and
+        sent outside of it, so no rows are locked while discord is called. A dispatcher that dies mid batch leaves
+        its messages to be sent again once the claim runs out. Only one dispatcher should be running at a time.
+        """
+
+        with transaction.atomic():
+            now = timezone.now()
+            waiting = DiscordOutboxMessage.objects.filter(sent_at=None, failed=False, next_attempt_at__gt=now) \
+                .values("channel")
+            pending = list(DiscordOutboxMessage.objects.select_for_update()
+                           .filter(sent_at=None, failed=False).exclude(channel__in=waiting)
+                           .order_by("id")[:batch_size])
+            if not pending:
+                return (0, 0)
+            DiscordOutboxMessage.objects.filter(pk__in=[m.pk for m in pending]) \
+                .update(next_attempt_at=now + datetime.timedelta(seconds=OUTBOX_CLAIM_TIMEOUT))
+
+        runs: Dict[int, List[DiscordOutboxMessage]] = {}
+        for m in pending:
+            runs.setdefault(m.channel_id, []).append(m)
+
+        num_sent = 0
+        num_failed = 0
+        api = get_client()
+        for channel_id, messages in runs.items():
+            for chunk in DiscordOutboxMessage._chunks(messages):
+                try:
+                    api.send_channel_message(channel_id, content="\n".join(m.content for m in chunk))
+                except Exception as e:
+                    logger.exception(f"Could not send outbox messages to channel {channel_id}")
+                    for m in chunk:
+                        m.attempts += 1
+                        m.last_error = str(e)[:500]
+                        m.next_attempt_at = timezone.now() + datetime.timedelta(
+                            seconds=min(2 ** m.attempts, OUTBOX_MAX_BACKOFF))
+                        m.failed = m.attempts >= OUTBOX_MAX_ATTEMPTS
+                    num_failed += len(chunk)
+                    break
+
+                sent_at = timezone.now()
+                for m in chunk:
+                    m.sent_at = sent_at
+                num_sent += len(chunk)
+
+        # The messages after a failure keep their original next attempt, they wait behind it in its channel
+        DiscordOutboxMessage.objects.bulk_update(
+            pending, ["attempts", "last_error", "next_attempt_at", "failed", "sent_at"])
+
+        return (num_sent, num_failed)
+
+    @staticmethod
+    def purge_sent(before: datetime.datetime) -> int:
+        """Deletes the messages sent before the given time, returns the number deleted."""
+
+        return DiscordOutboxMessage.objects.filter(sent_at__lt=before).delete()[0]
+
+
 class RoleInvite(models.Model):
     link = models.CharField("Link", max_length=40, primary_key=True)
     role = models.CharField("Role IDs", max_length=200)
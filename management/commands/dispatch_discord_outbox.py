@@ -0,0 +1,39 @@
+import time
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from common_models.models import DiscordOutboxMessage
+
+PURGE_INTERVAL = 3600
+
+
+class Command(BaseCommand):
+    help = "Sends the discord messages queued in the outbox."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Empty the outbox once and exit.")
+        parser.add_argument("--batch-size", type=int, default=100, help="Messages to send per batch.")
+        parser.add_argument("--interval", type=float, default=1.0,
+                            help="Seconds to wait before checking again when there is nothing to send.")
+        parser.add_argument("--keep-days", type=int, default=7, help="Days to keep sent messages for.")
+
+    def handle(self, *args, **options):
+        last_purge = 0.0
+        while True:
+            if time.monotonic() - last_purge >= PURGE_INTERVAL:
+                before = timezone.now() - datetime.timedelta(days=options["keep_days"])
+                purged = DiscordOutboxMessage.purge_sent(before)
+                if purged:
+                    self.stdout.write(f"Purged {purged} sent message(s)")
+                last_purge = time.monotonic()
+
+            sent, failed = DiscordOutboxMessage.dispatch_pending(options["batch_size"])
+            if sent or failed:
+                self.stdout.write(f"Sent {sent} message(s), {failed} failed")
+                continue
+
+            if options["once"]:
+                return
+            time.sleep(options["interval"])
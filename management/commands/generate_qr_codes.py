@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from common_models.models import Puzzle, QRCode
+
+
+class Command(BaseCommand):
+    help = "Brings the answer QR codes of the puzzles, all of them by default, up to date."
+
+    def add_arguments(self, parser):
+        parser.add_argument("puzzles", nargs="*", type=int, help="Ids of the puzzles to regenerate.")
+        parser.add_argument("--stream", type=int, action="append", default=[],
+                            help="Regenerate the puzzles of the stream, can be given more than once.")
+        parser.add_argument("--workers", type=int, default=None,
+                            help="Processes to render with, all cores by default.")
+
+    def handle(self, *args, **options):
+        puzzles = Puzzle.objects.order_by("stream", "order")
+        if options["puzzles"] or options["stream"]:
+            puzzles = puzzles.filter(pk__in=options["puzzles"]) | puzzles.filter(stream__in=options["stream"])
+
+        def progress(done: int, total: int) -> None:
+            if done % 25 == 0 or done == total:
+                self.stdout.write(f"Rendered {done}/{total} QR code(s)")
+
+        rendered = QRCode.generate_for_puzzles(puzzles, options["workers"], progress)
+        self.stdout.write(self.style.SUCCESS(f"Done, rendered {rendered} new QR code(s)"))
@@ -0,0 +1,30 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from common_models.models import MagicLink
+
+
+class Command(BaseCommand):
+    help = "Gives users a magic link with a QR code, carrying on from where an earlier run stopped."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--group", action="append", default=[],
+                            help="Only issue links to members of the group, can be given more than once.")
+        parser.add_argument("--hostname", default=None, help="Host the links point to.")
+        parser.add_argument("--redirect", default=None, help="Where to send users after they log in.")
+        parser.add_argument("--batch-size", type=int, default=500, help="Links to create and render at a time.")
+        parser.add_argument("--workers", type=int, default=None,
+                            help="Processes to render with, all cores by default.")
+
+    def handle(self, *args, **options):
+        users = User.objects.filter(is_active=True)
+        if options["group"]:
+            users = users.filter(groups__name__in=options["group"])
+
+        def progress(done: int, total: int) -> None:
+            self.stdout.write(f"Issued {done}/{total} magic link(s)")
+
+        issued = MagicLink.issue_many(users, hostname=options["hostname"], redirect=options["redirect"],
+                                      workers=options["workers"], batch_size=options["batch_size"],
+                                      progress=progress)
+        self.stdout.write(self.style.SUCCESS(f"Issued {issued} magic link(s)"))
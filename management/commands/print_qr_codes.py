@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from common_models.models import MagicLink, QRCode
+from common_models.print_sheets import SheetLayout, read_files, write_pdf
+
+
+class Command(BaseCommand):
+    help = "Writes the puzzle and/or magic link QR codes to a PDF to print, many to a page."
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="Path of the PDF to write.")
+        parser.add_argument("--puzzles", action="store_true", help="Print the puzzle answer QR codes.")
+        parser.add_argument("--magic-links", action="store_true", help="Print the magic link QR codes.")
+        parser.add_argument("--columns", type=int, default=SheetLayout().columns, help="Codes across a page.")
+        parser.add_argument("--rows", type=int, default=SheetLayout().rows, help="Codes down a page.")
+        parser.add_argument("--workers", type=int, default=None,
+                            help="Processes to lay out pages with, all cores by default.")
+
+    def handle(self, *args, **options):
+        if not options["puzzles"] and not options["magic_links"]:
+            raise CommandError("Give --puzzles, --magic-links or both.")
+
+        def files():
+            if options["puzzles"]:
+                for code in QRCode.objects.exclude(qr_code="").exclude(qr_code=None) \
+                        .order_by("puzzle__stream", "puzzle__order", "pk").iterator():
+                    yield code.qr_code
+            if options["magic_links"]:
+                for link in MagicLink.objects.exclude(qr_code="") \
+                        .order_by("user__last_name", "user__first_name", "pk").iterator():
+                    yield link.qr_code
+
+        def progress(pages: int) -> None:
+            self.stdout.write(f"Wrote page {pages}")
+
+        layout = SheetLayout(columns=options["columns"], rows=options["rows"])
+        pages = write_pdf(options["output"], read_files(files()), layout, options["workers"], progress)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {pages} page(s) to {options['output']}"))
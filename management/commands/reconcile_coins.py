@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from common_models.models import CoinTransaction
+
+
+class Command(BaseCommand):
+    help = "Checks that the coins of every team equal the sum of its coin ledger, run it periodically."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix", action="store_true", help="Set mismatched balances to their ledger sums.")
+
+    def handle(self, *args, **options):
+        mismatched = CoinTransaction.reconcile(fix=options["fix"])
+        for team_id, (balance, total) in mismatched.items():
+            self.stdout.write(f"Team {team_id}: balance {balance}, ledger {total}")
+        if not mismatched:
+            self.stdout.write(self.style.SUCCESS("Every team's coins match its ledger"))
+        elif options["fix"]:
+            self.stdout.write(self.style.SUCCESS(f"Corrected {len(mismatched)} team(s)"))
+        else:
+            self.stdout.write(self.style.ERROR(f"{len(mismatched)} team(s) do not match their ledger"))
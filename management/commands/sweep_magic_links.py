@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from common_models.models import MagicLink
+
+
+class Command(BaseCommand):
+    help = "Deletes expired magic links and their QR codes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="Links to delete at a time.")
+
+    def handle(self, *args, **options):
+        deleted = MagicLink.sweep_expired(options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} expired magic link(s)"))
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.4 on 2026-10-17 12:00
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common_models', '0091_alter_sponsorlogo_link'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiscordOutboxMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('sent_at', models.DateTimeField(blank=True, default=None, null=True)),
+                ('failed', models.BooleanField(default=False)),
+                ('last_error', models.CharField(blank=True, default='', max_length=500)),
+                ('channel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outbox_messages', to='common_models.discordchannel')),
+            ],
+            options={
+                'verbose_name': 'Discord Outbox Message',
+                'verbose_name_plural': 'Discord Outbox Messages',
+                'indexes': [models.Index(fields=['sent_at', 'failed', 'id'], name='discord_outbox_pending_idx')],
+            },
+        ),
+    ]
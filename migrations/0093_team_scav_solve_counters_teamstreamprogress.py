@@ -0,0 +1,77 @@
+# Generated by Django 5.1.4 on 2026-10-17 12:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def rebuild_solve_counters(apps, schema_editor):
+    Team = apps.get_model("common_models", "Team")
+    TeamPuzzleActivity = apps.get_model("common_models", "TeamPuzzleActivity")
+    TeamStreamProgress = apps.get_model("common_models", "TeamStreamProgress")
+
+    def count(activities):
+        return Coalesce(Subquery(activities.order_by().values("team").annotate(c=Count("pk")).values("c")), Value(0))
+
+    verified = TeamPuzzleActivity.objects.filter(team=OuterRef("pk"), verification_photo__approved=True)
+    solved = verified.filter(puzzle__enabled=True).exclude(puzzle_completed_at=None)
+    main = solved.filter(puzzle__stream__enabled=True, puzzle__stream__default=True)
+    last = TeamPuzzleActivity.objects.filter(team=OuterRef("pk")).exclude(puzzle_completed_at=None) \
+        .order_by("-puzzle_completed_at").values("puzzle_completed_at")[:1]
+    Team.objects.update(scav_verified_solves=count(verified), scav_main_solves=count(main),
+                        scav_last_solve_at=Subquery(last))
+
+    per_stream = TeamPuzzleActivity.objects \
+        .filter(verification_photo__approved=True, puzzle__enabled=True) \
+        .exclude(puzzle_completed_at=None).order_by().values("team", "puzzle__stream") \
+        .annotate(n=Count("pk"), last=Max("puzzle_completed_at"))
+    TeamStreamProgress.objects.bulk_create([
+        TeamStreamProgress(team_id=row["team"], stream_id=row["puzzle__stream"],
+                           verified_solves=row["n"], last_solve_at=row["last"])
+        for row in per_stream])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common_models', '0092_discordoutboxmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='team',
+            name='scav_last_solve_at',
+            field=models.DateTimeField(blank=True, default=None, null=True, verbose_name='Last Solve'),
+        ),
+        migrations.AddField(
+            model_name='team',
+            name='scav_main_solves',
+            field=models.IntegerField(default=0, verbose_name='Main Stream Solves'),
+        ),
+        migrations.AddField(
+            model_name='team',
+            name='scav_verified_solves',
+            field=models.IntegerField(default=0, verbose_name='Verified Solves'),
+        ),
+        migrations.AddIndex(
+            model_name='team',
+            index=models.Index(fields=['-scav_main_solves', 'scav_last_solve_at'], name='team_scav_leaderboard_idx'),
+        ),
+        migrations.CreateModel(
+            name='TeamStreamProgress',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('verified_solves', models.IntegerField(default=0)),
+                ('last_solve_at', models.DateTimeField(blank=True, default=None, null=True)),
+                ('stream', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='common_models.puzzlestream')),
+                ('team', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='common_models.team')),
+            ],
+            options={
+                'verbose_name': 'Team Stream Progress',
+                'verbose_name_plural': 'Team Stream Progress',
+                'unique_together': {('team', 'stream')},
+            },
+        ),
+        migrations.RunPython(rebuild_solve_counters, migrations.RunPython.noop),
+    ]
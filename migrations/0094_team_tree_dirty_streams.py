@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common_models', '0093_team_scav_solve_counters_teamstreamprogress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='team',
+            name='tree_dirty_streams',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common_models', '0094_team_tree_dirty_streams'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='qrcode',
+            name='digest',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+    ]
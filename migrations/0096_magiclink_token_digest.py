@@ -0,0 +1,29 @@
+# Generated by Django 5.1.4 on 2026-10-17 12:00
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_tokens(apps, schema_editor):
+    MagicLink = apps.get_model("common_models", "MagicLink")
+    links = list(MagicLink.objects.only("pk", "token"))
+    for link in links:
+        link.token = hashlib.sha256(link.token.encode()).hexdigest()
+    MagicLink.objects.bulk_update(links, ["token"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common_models', '0095_qrcode_digest'),
+    ]
+
+    operations = [
+        migrations.RunPython(hash_tokens, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='magiclink',
+            name='token',
+            field=models.CharField(editable=False, max_length=64, unique=True),
+        ),
+    ]
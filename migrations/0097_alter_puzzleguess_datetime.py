@@ -0,0 +1,19 @@
+# Generated by Django 5.1.4 on 2026-10-17 12:00
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common_models', '0096_magiclink_token_digest'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='puzzleguess',
+            name='datetime',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
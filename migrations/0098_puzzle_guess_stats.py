@@ -0,0 +1,62 @@
+# Generated by Django 5.1.4 on 2026-10-17 12:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common_models', '0097_alter_puzzleguess_datetime'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='puzzleguess',
+            name='correct',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='PuzzleGuessStats',
+            fields=[
+                ('puzzle', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='guess_stats', serialize=False, to='common_models.puzzle')),
+                ('guesses', models.IntegerField(default=0)),
+                ('wrong_guesses', models.IntegerField(default=0)),
+                ('solves', models.IntegerField(default=0)),
+                ('total_solve_seconds', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Puzzle Guess Stats',
+                'verbose_name_plural': 'Puzzle Guess Stats',
+            },
+        ),
+        migrations.CreateModel(
+            name='PuzzleWrongAnswer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.CharField(max_length=100)),
+                ('count', models.IntegerField(default=0)),
+                ('puzzle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='common_models.puzzle')),
+            ],
+            options={
+                'verbose_name': 'Puzzle Wrong Answer',
+                'verbose_name_plural': 'Puzzle Wrong Answers',
+                'indexes': [models.Index(fields=['puzzle', '-count'], name='puzzle_wrong_answer_top_idx')],
+                'unique_together': {('puzzle', 'value')},
+            },
+        ),
+        migrations.CreateModel(
+            name='PuzzleSolveTimeBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.SmallIntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('puzzle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='common_models.puzzle')),
+            ],
+            options={
+                'verbose_name': 'Puzzle Solve Time Bucket',
+                'verbose_name_plural': 'Puzzle Solve Time Buckets',
+                'unique_together': {('puzzle', 'bucket')},
+            },
+        ),
+    ]
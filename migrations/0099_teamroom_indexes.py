@@ -0,0 +1,21 @@
+# Generated by Django 5.1.4 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common_models', '0098_puzzle_guess_stats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='teamroom',
+            index=models.Index(fields=['team', 'date'], name='teamroom_team_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='teamroom',
+            index=models.Index(fields=['date'], name='teamroom_date_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.1.4 on 2026-10-17 12:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def record_opening_balances(apps, schema_editor):
+    Team = apps.get_model("common_models", "Team")
+    CoinTransaction = apps.get_model("common_models", "CoinTransaction")
+    CoinTransaction.objects.bulk_create(
+        [CoinTransaction(team_id=team_id, amount=amount, reason="Opening balance")
+         for team_id, amount in Team.objects.exclude(coin_amount=0).values_list("pk", "coin_amount")])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common_models', '0099_teamroom_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoinTransaction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.BigIntegerField()),
+                ('reason', models.CharField(blank=True, default='', max_length=200)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('created_by', models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+                ('team', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='coin_transactions', to='common_models.team')),
+            ],
+            options={
+                'verbose_name': 'Coin Transaction',
+                'verbose_name_plural': 'Coin Transactions',
+                'indexes': [models.Index(fields=['team', 'created_at'], name='coin_transaction_team_idx')],
+            },
+        ),
+        migrations.RunPython(record_opening_balances, migrations.RunPython.noop),
+    ]
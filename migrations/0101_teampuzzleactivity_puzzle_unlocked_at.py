@@ -0,0 +1,33 @@
+# Generated by Django 5.1.4 on 2026-10-17 12:00
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+
+
+def copy_start_times(apps, schema_editor):
+    # The best guess there is for the activities unlocked before the field was added
+    TeamPuzzleActivity = apps.get_model("common_models", "TeamPuzzleActivity")
+    TeamPuzzleActivity.objects.update(puzzle_unlocked_at=F("puzzle_start_at"))
+
+
+def rebuild_guess_stats(apps, schema_editor):
+    from common_models.scav_stats_models import PuzzleGuessStats
+    PuzzleGuessStats.rebuild(apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common_models', '0100_cointransaction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='teampuzzleactivity',
+            name='puzzle_unlocked_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.RunPython(copy_start_times, migrations.RunPython.noop),
+        migrations.RunPython(rebuild_guess_stats, migrations.RunPython.noop),
+    ]
@@ -106,19 +106,23 @@ from .teams_models import Team, VirtualTeam, TeamRoom  # noqa: E402, F401
 from .scav_models import PuzzleStream, Puzzle, VerificationPhoto  # noqa: E402, F401
 from .scav_models import _puzzle_verification_photo_upload_path  # noqa: E402, F401
 from .scav_models import PuzzleGuess, TeamPuzzleActivity, LockoutPeriod, QRCode  # noqa: E402, F401
+from .scav_models import TeamStreamProgress, ScavengerLockedOut  # noqa: E402, F401
+from .scav_stats_models import PuzzleGuessStats, PuzzleWrongAnswer, PuzzleSolveTimeBucket  # noqa: E402, F401
 from .discord_models import DiscordUser, RoleInvite, DiscordChannel, get_client  # noqa: E402, F401
 from .discord_models import DiscordOverwrite, ChannelTag, DiscordRole, DiscordGuild  # noqa: E402, F401
-from .discord_models import DiscordMessage  # noqa: E402, F401
+from .discord_models import DiscordMessage, DiscordOutboxMessage  # noqa: E402, F401
 from .data_models import UniversityProgram, UserDetails, FroshRole, BooleanSetting  # noqa: E402, F401
 from .data_models import Announcement, Pronoun, PronounOption, InclusivityPage, FAQPage  # noqa: E402, F401
 from .data_models import FacilShift, FacilShiftSignup, Setting, RoleOption, SiteImage, SiteSVG  # noqa: E402, F401
 from .data_models import SponsorLogo  # noqa: E402, F401
 from .auth_models import MagicLink  # noqa: E402, F401
 from .trade_models import TeamTradeUpActivity  # noqa: E402, F401
+from .coin_models import CoinTransaction, CoinStandings  # noqa: E402, F401
 from .calendar_models import EventManager, Event, EventRelationManager, EventRelation  # noqa: E402, F401
 from .calendar_models import Occurrence, CalendarManager, Calendar, CalendarRelationManager  # noqa: E402, F401
 from .calendar_models import Rule, CalendarRelation  # noqa: E402, F401
 from .randall_models import RandallBlocked, RandallBooking, RandallLocation  # noqa: E402, F401
+from .site_settings import seed_settings  # noqa: E402
 logger = logging.getLogger("common_models.models")
 
 
@@ -140,24 +144,14 @@ PUZZLE_SECRET_ID_LENGTH = 16
 def initialize_database() -> None:
     ChannelTag.objects.get_or_create(name="SCAVENGER_MANAGEMENT_UPDATES_CHANNEL")
     ChannelTag.objects.get_or_create(name="TRADE_UP_MANAGEMENT_UPDATES_CHANNEL")
-    BooleanSetting.objects.get_or_create(id="SCAVENGER_ENABLED")
-    BooleanSetting.objects.get_or_create(id="TRADE_UP_ENABLED")
-    BooleanSetting.objects.get_or_create(id="DISCORD_ENABLED")
-    BooleanSetting.objects.get_or_create(id="REGISTRATION_ENABLED", defaults={'value': False})
-    BooleanSetting.objects.get_or_create(id="DISCORD_LOGIN_ENABLED")
-    Setting.objects.get_or_create(id="MAX_FACIL_SHIFTS", defaults={'value': '2'})
+    seed_settings()
 
 
 def initialize_scav() -> None:
-    for team in Team.objects.all():
-        streams = PuzzleStream.objects.filter(enabled=True, default=True)
-
-        for s in streams:
-            puz = s.first_enabled_puzzle
-            try:
-                pa = TeamPuzzleActivity(team=team, puzzle=puz)
-                pa.save()
-            except Exception:
-                pass
+    """Gives every team the first puzzle of each default stream, leaving the activities they already have."""
+
+    first_ids = PuzzleStream.default_first_puzzle_ids()
+    team_ids = Team.objects.values_list("pk", flat=True)
+    TeamPuzzleActivity.unlock((t, p) for t in team_ids for p in first_ids)
 
 # endregion
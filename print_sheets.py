@@ -0,0 +1,143 @@
+"""
+Print sheets of QR code images, laid out many to a page in a multi-page PDF.
+
+Pages are composed in a process pool, with only a few pages in flight at a time, and the PDF is written in one pass.
+Pillow collects every page before writing any, so the pages are held PNG compressed and decoded one at a time as
+they are written, and memory stays flat however many codes are printed. Like qr_render this module does not import
+the models, the images are read from storage by the caller.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from io import BytesIO
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from PIL import Image
+from PIL.PngImagePlugin import PngImageFile
+
+
+class SheetLayout(NamedTuple):
+    """A grid of equally sized cells on a page, sizes in inches."""
+
+    columns: int = 3
+    rows: int = 4
+    page_width: float = 8.5
+    page_height: float = 11
+    margin: float = 0.4
+    dpi: int = 150
+
+    @property
+    def per_page(self) -> int:
+        return self.columns * self.rows
+
+    @property
+    def page_size(self) -> Tuple[int, int]:
+        return (int(self.page_width * self.dpi), int(self.page_height * self.dpi))
+
+    def cells(self) -> List[Tuple[int, int, int, int]]:
+        """The (left, top, width, height) of each cell in pixels, row by row."""
+
+        margin = int(self.margin * self.dpi)
+        width, height = self.page_size
+        cell_width = (width - 2 * margin) // self.columns
+        cell_height = (height - 2 * margin) // self.rows
+        return [(margin + c * cell_width, margin + r * cell_height, cell_width, cell_height)
+                for r in range(self.rows) for c in range(self.columns)]
+
+
+def compose_page(images: List[bytes], layout: SheetLayout) -> bytes:
+    """A PNG of a page with the encoded images centred in its cells, scaled down to fit."""
+
+    page = Image.new("RGB", layout.page_size, (255, 255, 255))
+    for data, (left, top, width, height) in zip(images, layout.cells()):
+        with Image.open(BytesIO(data)) as im:
+            im = im.convert("RGB")
+            im.thumbnail((width, height))
+            page.paste(im, (left + (width - im.width) // 2, top + (height - im.height) // 2))
+    out = BytesIO()
+    page.save(out, "PNG", compress_level=1)
+    return out.getvalue()
+
+
+class _Page(PngImageFile):
+    """A composed page, decoding it releases the page decoded before it so that one page is decoded at a time."""
+
+    def __init__(self, data: bytes, decoded: List[Optional["_Page"]]) -> None:
+        super().__init__(BytesIO(data))
+        self._decoded = decoded
+
+    def load(self):
+        previous = self._decoded[0]
+        if previous is not None and previous is not self:
+            previous.close()
+        self._decoded[0] = self
+        return super().load()
+
+
+def _batches(items: Iterable[bytes], size: int) -> Iterator[List[bytes]]:
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _imap_bounded(fn: Callable, items: Iterator, workers: Optional[int]) -> Iterator:
+    """Like map, in a process pool that is never more than two items a worker ahead of the consumer."""
+
+    if workers == 1:
+        yield from map(fn, items)
+        return
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def read_files(files: Iterable) -> Iterator[bytes]:
+    """The contents of the stored files, FieldFiles or anything with a name and storage, one at a time."""
+
+    for f in files:
+        if not f:
+            continue
+        with f.storage.open(f.name, "rb") as fh:
+            yield fh.read()
+
+
+def write_pdf(path: str, images: Iterable[bytes], layout: SheetLayout = SheetLayout(),
+              workers: Optional[int] = None, progress: Optional[Callable[[int], None]] = None) -> int:
+    """
+    Writes the encoded images to a PDF at path, layout.per_page to a page, returns the number of pages.
+
+    The images are consumed lazily, so they can be read from storage as the pages are composed. progress is called
+    with the number of pages composed after each one, nothing is written until every page is.
+    """
+
+    decoded: List[Optional[_Page]] = [None]
+    pages = 0
+
+    def composed() -> Iterator[_Page]:
+        nonlocal pages
+        for data in _imap_bounded(partial(compose_page, layout=layout), _batches(images, layout.per_page), workers):
+            pages += 1
+            if progress is not None:
+                progress(pages)
+            yield _Page(data, decoded)
+
+    pages_iter = composed()
+    first = next(pages_iter, None)
+    if first is None:
+        return 0
+    # Appending page by page would have Pillow read back and rewrite the whole file for every page
+    first.save(path, "PDF", save_all=True, append_images=pages_iter, resolution=layout.dpi)
+    return pages
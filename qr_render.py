@@ -0,0 +1,116 @@
+"""
+Rendering of labelled QR code images.
+
+Kept free of model imports so that the worker processes rendering a batch only need qrcode and Pillow. Fonts and
+embedded images are loaded once per process rather than once per image.
+"""
+
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from io import BytesIO
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+import qrcode
+import qrcode.constants
+from qrcode.image.styledpil import StyledPilImage
+from PIL import Image, ImageDraw, ImageFont
+
+FONT_SIZE = 40
+LABEL_HEIGHT = 50
+
+
+class QRStyle(NamedTuple):
+    """Everything about a QR image but its data and label, loaded once for a batch."""
+
+    font_path: str
+    # Placed in the middle of the code when set
+    image_path: Optional[str] = None
+    # White space on either side of the code when the label is narrower than it
+    padding: int = 0
+
+
+@lru_cache(maxsize=8)
+def _font(path: str) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(path, FONT_SIZE)
+
+
+@lru_cache(maxsize=8)
+def _embedded_image(path: str) -> Image.Image:
+    image = Image.open(path)
+    image.load()
+    return image
+
+
+def style_digest(style: QRStyle) -> str:
+    """A digest of the contents of the style's files and its padding, read once for a batch."""
+
+    h = hashlib.sha256()
+    for path in (style.font_path, style.image_path):
+        if path:
+            with open(path, "rb") as f:
+                h.update(hashlib.sha256(f.read()).digest())
+        else:
+            h.update(b"\0")
+    h.update(str(style.padding).encode())
+    return h.hexdigest()
+
+
+def image_digest(data: str, label: str, style_key: str) -> str:
+    """A digest of everything the image is rendered from, the same inputs always give the same image."""
+
+    return hashlib.sha256("\0".join((data, label, style_key)).encode()).hexdigest()
+
+
+def render_png(data: str, label: str, style: QRStyle) -> bytes:
+    """A PNG of the QR code for the data with the label written underneath."""
+
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_H)
+    qr.add_data(data)
+    qr.make(fit=True)
+
+    if style.image_path:
+        img = qr.make_image(image_factory=StyledPilImage, embeded_image=_embedded_image(style.image_path))
+    else:
+        img = qr.make_image()
+
+    orig_width = img.size[0]
+    height = img.size[1]
+    font = _font(style.font_path)
+    text_len = font.getlength(label)
+    width = int(max(orig_width + 2 * style.padding, text_len + 50))
+    offset = style.padding
+    if text_len + 50 > orig_width:
+        offset = int((text_len + 50 - orig_width)/2)
+    with_text = Image.new(mode="RGB", size=(width, height + LABEL_HEIGHT))
+    draw = ImageDraw.Draw(with_text)
+    draw.rectangle([(0, 0), with_text.size], fill=(255, 255, 255))
+    with_text.paste(img._img, (offset, 0))  # The PIL image inside the qrcode image
+    draw.text((width/2-text_len/2, height - 30),
+              label, align="center", fill=(0, 0, 0), font=font)
+
+    blob = BytesIO()
+    with_text.save(blob, "PNG")
+    return blob.getvalue()
+
+
+def _render_job(job: Tuple[str, str], style: QRStyle) -> bytes:
+    return render_png(job[0], job[1], style)
+
+
+def render_many(jobs: List[Tuple[str, str]], style: QRStyle, workers: Optional[int] = None,
+                chunksize: int = 8) -> Iterator[bytes]:
+    """
+    PNGs for the (data, label) jobs, yielded in the order of the jobs as they are rendered.
+
+    Rendering is spread over a process pool of the given size, all cores by default, and done in this process
+    when workers is 1 or there is only one job.
+    """
+
+    if workers == 1 or len(jobs) <= 1:
+        for data, label in jobs:
+            yield render_png(data, label, style)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(partial(_render_job, style=style), jobs, chunksize=chunksize)
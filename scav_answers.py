@@ -0,0 +1,45 @@
+"""Precompiled answer lookups for scavenger puzzles."""
+
+from functools import lru_cache
+from typing import Dict, Iterator, NamedTuple, Tuple
+
+# TeamPuzzleActivity.completed_bitmask only has room for this many answers
+MAX_ANSWERS = 32
+
+
+class AnswerIndex(NamedTuple):
+    """The answers of a puzzle and the completed_bitmask bits each normalized answer sets."""
+
+    answers: Tuple[str, ...]
+    masks: Dict[str, int]
+    full_mask: int
+
+
+def normalize_answer(answer: str) -> str:
+    return answer.lower()
+
+
+@lru_cache(maxsize=2048)
+def answer_index(answer: str) -> AnswerIndex:
+    """
+    Builds the index for a puzzle's comma separated answer field.
+
+    The cache is keyed on the text of the field, so editing a puzzle's answer invalidates it.
+    Duplicate answers map to all of their bits, matching the old behaviour of setting each one.
+    """
+
+    answers = tuple(answer.split(","))
+    masks: Dict[str, int] = {}
+    for i, a in enumerate(answers[:MAX_ANSWERS]):
+        key = normalize_answer(a)
+        masks[key] = masks.get(key, 0) | 1 << i
+    return AnswerIndex(answers, masks, (1 << min(len(answers), MAX_ANSWERS)) - 1)
+
+
+def set_bits(mask: int) -> Iterator[int]:
+    """Yields the positions of the bits set in the mask, lowest first."""
+
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
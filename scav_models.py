@@ -1,17 +1,26 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Concat
+from django.db.models.signals import post_delete, post_save
+from django.core.signals import request_finished
+from django.dispatch import receiver
+from django.utils import timezone
 import logging
-from io import BytesIO
+import datetime
 from django.db.models.deletion import CASCADE, PROTECT, SET_NULL
 from django.conf import settings
-from typing import List, Optional, Tuple, Union
-import datetime
-import qrcode
-import qrcode.constants
-from qrcode.image.styledpil import StyledPilImage
-from django.core.files import File
-from PIL import Image, ImageDraw, ImageFont
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, Union
+from bisect import bisect_right
+from collections import Counter
+from decimal import Decimal
+from django.core.files.base import ContentFile
 
 import common_models.models as md
+from common_models import site_settings
+from common_models.buffering import WriteBehindBuffer
+from common_models.caching import VersionedCache
+from common_models.qr_render import QRStyle, image_digest, render_many, render_png, style_digest
+from common_models.scav_answers import AnswerIndex, answer_index, normalize_answer, set_bits
 logger = logging.getLogger("common_models.scav_models")
 
 PUZZLE_VERIFICATION_DIR = "verification_photos/"
@@ -21,6 +30,10 @@ def _puzzle_verification_photo_upload_path(instance, filename) -> str:
     return md.random_path(instance, filename, PUZZLE_VERIFICATION_DIR)
 
 
+class ScavengerLockedOut(Exception):
+    """Raised by Puzzle.check_team_guess for a guess on a stream that is locked out, the guess is not checked."""
+
+
 class LockoutPeriod(models.Model):
     start = models.DateTimeField()
     end = models.DateTimeField()
@@ -30,18 +43,164 @@ class LockoutPeriod(models.Model):
         verbose_name = "Lockout Period"
         verbose_name_plural = "Lockout Periods"
 
+    @staticmethod
+    def is_locked(stream_id: Optional[int] = None, at: Optional[datetime.datetime] = None) -> bool:
+        """
+        Whether scav is locked at the time, now by default, by a global period or one for the stream.
+
+        Answered from the cached intervals without a query while the lockout periods are unchanged.
+        """
+
+        t = (at or timezone.now()).timestamp()
+        intervals = _lockout_intervals.get()
+        if intervals.get(None, EMPTY_LOCKOUT_INTERVALS).contains(t):
+            return True
+        return stream_id is not None and intervals.get(stream_id, EMPTY_LOCKOUT_INTERVALS).contains(t)
+
+
+class LockoutIntervals(NamedTuple):
+    """Sorted, non overlapping lockout intervals as timestamps, ends included."""
+
+    starts: Tuple[float, ...]
+    ends: Tuple[float, ...]
+
+    def contains(self, t: float) -> bool:
+        i = bisect_right(self.starts, t) - 1
+        return i >= 0 and t <= self.ends[i]
+
+
+EMPTY_LOCKOUT_INTERVALS = LockoutIntervals((), ())
+
+
+def _build_lockout_intervals() -> Dict[Optional[int], LockoutIntervals]:
+    """Merges the lockout periods of each branch, None being the periods that lock every stream."""
+
+    merged: Dict[Optional[int], List[List[float]]] = {}
+    for branch_id, start, end in LockoutPeriod.objects.order_by("start").values_list("branch_id", "start", "end"):
+        intervals = merged.setdefault(branch_id, [])
+        start, end = start.timestamp(), end.timestamp()
+        if intervals and start <= intervals[-1][1]:
+            intervals[-1][1] = max(intervals[-1][1], end)
+        else:
+            intervals.append([start, end])
+    return {branch_id: LockoutIntervals(tuple(i[0] for i in intervals), tuple(i[1] for i in intervals))
+            for branch_id, intervals in merged.items()}
+
+
+_lockout_intervals: VersionedCache[Dict[Optional[int], LockoutIntervals]] = \
+    VersionedCache("lockout_intervals", _build_lockout_intervals)
+
 
 class PuzzleGuess(models.Model):
     """Stores all the guesses for scavenger."""
 
-    datetime = models.DateTimeField(auto_now=True)
+    datetime = models.DateTimeField(default=timezone.now)
     value = models.CharField(max_length=100)
     activity = models.ForeignKey('TeamPuzzleActivity', on_delete=CASCADE)
+    correct = models.BooleanField(default=False)
 
     class Meta:
         verbose_name = "Puzzle Guess"
         verbose_name_plural = "Puzzle Guesses"
 
+    @staticmethod
+    def record(activity: "TeamPuzzleActivity", value: str, completed: bool) -> None:
+        """
+        Buffers the guess to be inserted with others, see GUESS_BUFFER_MAX_SIZE and GUESS_BUFFER_MAX_AGE.
+
+        The guess is correct if it is one of the puzzle's answers, even one the team had already found, and
+        completed is whether it completed the puzzle. The puzzle's guess statistics are updated as the guesses are
+        inserted, from the activity as it was after the guess, which has to have its puzzle loaded.
+        """
+
+        guess = PuzzleGuess(value=value, activity=activity,
+                            correct=normalize_answer(value) in activity.puzzle.answer_index.masks)
+        # Not stored, only the statistics need it
+        guess.completed_puzzle = completed
+        _guess_buffer.add(guess)
+
+    @staticmethod
+    def flush() -> int:
+        """Inserts the guesses buffered by this process now, returns the number inserted."""
+
+        return _guess_buffer.flush()
+
+
+# Guesses are only read by organizers after the fact. A process that crashes loses at most this many of them,
+# one that exits cleanly loses none.
+GUESS_BUFFER_MAX_SIZE = 50
+GUESS_BUFFER_MAX_AGE = 10.0
+
+
+def _guesses_with_activities(guesses: List[PuzzleGuess]) -> List[PuzzleGuess]:
+    """The guesses whose activities were not deleted, by a reset or an organizer, while they were buffered."""
+
+    existing = set(md.TeamPuzzleActivity.objects.filter(pk__in={g.activity_id for g in guesses})
+                   .values_list("pk", flat=True))
+    kept = [g for g in guesses if g.activity_id in existing]
+    if len(kept) < len(guesses):
+        logger.warning(f"Dropping {len(guesses) - len(kept)} buffered guesses to deleted puzzle activities")
+    return kept
+
+
+_guess_buffer: WriteBehindBuffer[PuzzleGuess] = \
+    WriteBehindBuffer(PuzzleGuess, GUESS_BUFFER_MAX_SIZE, GUESS_BUFFER_MAX_AGE,
+                      lambda guesses: md.PuzzleGuessStats.record_guesses(guesses), _guesses_with_activities)
+
+
+def _dirty_streams_value(stream_ids: Iterable[int]) -> str:
+    """Streams as appended to Team.tree_dirty_streams, each id followed by a comma."""
+
+    return "".join(f"{s}," for s in stream_ids)
+
+
+class StreamOrder(NamedTuple):
+    """The enabled puzzles of a stream in order, and the last puzzle of the stream whether enabled or not."""
+
+    orders: Tuple[Decimal, ...]
+    ids: Tuple[int, ...]
+    last_id: Optional[int]
+
+    @property
+    def first_id(self) -> Optional[int]:
+        return self.ids[0] if self.ids else None
+
+    def next_id(self, order) -> Optional[int]:
+        """The id of the first enabled puzzle after the order, None if there is none."""
+
+        i = bisect_right(self.orders, Puzzle._meta.get_field("order").to_python(order))
+        return self.ids[i] if i < len(self.ids) else None
+
+
+EMPTY_STREAM_ORDER = StreamOrder((), (), None)
+
+
+class StreamIndex(NamedTuple):
+    """The order of every stream and the stream of every puzzle."""
+
+    orders: Dict[int, StreamOrder]
+    puzzle_streams: Dict[int, int]
+
+
+def _build_stream_index() -> StreamIndex:
+    orders: Dict[int, List[Decimal]] = {}
+    ids: Dict[int, List[int]] = {}
+    last: Dict[int, int] = {}
+    puzzle_streams: Dict[int, int] = {}
+    for stream_id, puzzle_id, order, enabled in Puzzle.objects.order_by("order") \
+            .values_list("stream_id", "id", "order", "enabled"):
+        last[stream_id] = puzzle_id
+        puzzle_streams[puzzle_id] = stream_id
+        if enabled:
+            orders.setdefault(stream_id, []).append(order)
+            ids.setdefault(stream_id, []).append(puzzle_id)
+    return StreamIndex({s: StreamOrder(tuple(orders.get(s, ())), tuple(ids.get(s, ())), last[s]) for s in last},
+                       puzzle_streams)
+
+
+# Puzzle structure barely changes during the event but is read on every guess and approval
+_stream_index: VersionedCache[StreamIndex] = VersionedCache("puzzle_stream_order", _build_stream_index)
+
 
 class PuzzleStream(models.Model):
     """Puzzle streams in scavenger"""
@@ -78,16 +237,48 @@ class PuzzleStream(models.Model):
         """Returns a list of enabled puzzles in order they are to be completed."""
         return list(self._all_enabled_puzzles_qs)
 
+    @staticmethod
+    def order_of(stream_id: int) -> StreamOrder:
+        """The cached order of the stream's puzzles, answered without a query while puzzles are unchanged."""
+
+        return _stream_index.get().orders.get(stream_id, EMPTY_STREAM_ORDER)
+
+    @staticmethod
+    def stream_id_of(puzzle_id: int) -> Optional[int]:
+        """The cached stream of the puzzle, None if there is no such puzzle."""
+
+        return _stream_index.get().puzzle_streams.get(puzzle_id)
+
+    @staticmethod
+    def structure_version() -> str:
+        """Changes whenever a puzzle or stream is saved or deleted."""
+
+        return _stream_index.version()
+
+    @staticmethod
+    def default_first_puzzle_ids() -> List[int]:
+        """The first enabled puzzle of every enabled default stream, the puzzles every team starts with."""
+
+        stream_ids = PuzzleStream.objects.filter(enabled=True, default=True).values_list("pk", flat=True)
+        first_ids = [PuzzleStream.order_of(s).first_id for s in stream_ids]
+        return [p for p in first_ids if p is not None]
+
     @property
     def first_enabled_puzzle(self) -> Optional:
         """Returns the first enabled puzzle for the stream if it exists."""
 
-        return self._all_enabled_puzzles_qs.first()
+        first_id = PuzzleStream.order_of(self.id).first_id
+        if first_id is None:
+            return None
+        return Puzzle.objects.get(pk=first_id)
 
     def get_next_enabled_puzzle(self, puzzle) -> Optional:
         """Returns the next puzzle, returns None if there are no more Puzzles, ie stream completed."""
 
-        return self._all_enabled_puzzles_qs.filter(order__gt=puzzle.order).order_by("order").first()
+        next_id = PuzzleStream.order_of(self.id).next_id(puzzle.order)
+        if next_id is None:
+            return None
+        return Puzzle.objects.get(pk=next_id)
 
 
 class VerificationPhoto(models.Model):
@@ -106,40 +297,102 @@ class VerificationPhoto(models.Model):
         ]
 
     def approve(self) -> None:
-        activity = TeamPuzzleActivity.objects.filter(verification_photo=self).first()
-        puzzle = activity.puzzle
-        team = activity.team
-        if puzzle.stream_branch is not None:
-            first_en = puzzle.stream_branch.first_enabled_puzzle
-            if first_en is not None:
-                try:
-                    branch_activity = TeamPuzzleActivity(team=team, puzzle=first_en)
-                    branch_activity.save()
-                except Exception:
-                    logger.warn("Team stream puzzle activity already exists for " + str(team) + ": " + str(puzzle))
-        if puzzle.stream_puzzle is not None:
-            try:
-                branch_activity = TeamPuzzleActivity(team=team, puzzle=puzzle.stream_puzzle)
-                branch_activity.save()
-            except Exception:
-                logger.warn("Team stream_puzzle puzzle activity already exists for " + str(team) + ": " + str(puzzle))
-        self.approved = True
-        self.save()
-        team.invalidate_tree = True
-        team.save()
-        if puzzle.last_puzzle_in_stream:
-            team.free_hints += 1
-            team.save()
-        next_puzzle = puzzle.stream.get_next_enabled_puzzle(puzzle)
-        if next_puzzle is not None:
-            try:
-                TeamPuzzleActivity(team=team, puzzle=next_puzzle).save()
-            except Exception:
-                pass
-        # try:
-        #     TeamPuzzleActivity.objects.get(verification_photo=self).team.refresh_scavenger_progress()
-        # except TeamPuzzleActivity.DoesNotExist:
-        #     pass
+        activity = TeamPuzzleActivity.objects.select_related("puzzle", "puzzle__stream", "team") \
+            .filter(verification_photo=self).first()
+        self._approve(activity)
+
+    def _approve(self, activity: "TeamPuzzleActivity") -> Optional[int]:
+        """Approves the photo for the activity and unlocks what follows it, returns the next puzzle's id."""
+
+        with transaction.atomic():
+            unlocked = TeamPuzzleActivity.unlock(VerificationPhoto._follow_on_grants([activity]))
+
+            # Only the approval that flips the photo counts the solve, so approving twice is harmless
+            newly_approved = VerificationPhoto.objects.filter(pk=self.pk, approved=False) \
+                .update(approved=True, datetime=timezone.now()) > 0
+            self.approved = True
+
+            VerificationPhoto._record_approvals([activity] if newly_approved else [],
+                                                [(activity.team_id, activity.puzzle_id), *unlocked])
+        return activity.puzzle.next_enabled_puzzle_id
+
+    @staticmethod
+    def approve_many(photos: models.QuerySet) -> int:
+        """
+        Approves every photo in the queryset, returns the number that were not approved yet.
+
+        Activities, follow-on puzzles and branch openers are resolved in bulk, the unlocked activities are
+        created with one insert and each team is updated once, however many of its photos are approved.
+        """
+
+        with transaction.atomic():
+            photo_ids = list(VerificationPhoto.objects.select_for_update()
+                             .filter(pk__in=photos.values("pk"), approved=False).values_list("pk", flat=True))
+            if not photo_ids:
+                return 0
+
+            activities = list(TeamPuzzleActivity.objects.filter(verification_photo__in=photo_ids)
+                              .select_related("puzzle", "puzzle__stream"))
+            unlocked = TeamPuzzleActivity.unlock(VerificationPhoto._follow_on_grants(activities))
+            VerificationPhoto.objects.filter(pk__in=photo_ids).update(approved=True, datetime=timezone.now())
+            VerificationPhoto._record_approvals(activities, [(a.team_id, a.puzzle_id) for a in activities] +
+                                                list(unlocked))
+
+        logger.info(f"Approved {len(photo_ids)} verification photos for {len(activities)} puzzle activities")
+        return len(photo_ids)
+
+    @staticmethod
+    def _follow_on_grants(activities: List["TeamPuzzleActivity"]) -> List[Tuple[int, int]]:
+        """The (team id, puzzle id) unlocked by approving the activities: the next puzzle and any branch they open."""
+
+        grants = []
+        for a in activities:
+            grants.extend((a.team_id, puzzle_id) for puzzle_id in a.puzzle.follow_on_puzzle_ids)
+        return grants
+
+    @staticmethod
+    def _record_approvals(approved: List["TeamPuzzleActivity"], touched: List[Tuple[int, int]]) -> None:
+        """
+        Adds the newly approved activities to the solve counters and free hints, and marks the streams of the
+        touched (team id, puzzle id), the approved ones and those they unlocked, for the teams' trees to re-render.
+        """
+
+        dirty: Dict[int, set] = {}
+        for team_id, puzzle_id in touched:
+            stream_id = PuzzleStream.stream_id_of(puzzle_id)
+            if stream_id is not None:
+                dirty.setdefault(team_id, set()).add(stream_id)
+
+        verified = Counter()
+        main = Counter()
+        hints = Counter()
+        stream_solves = Counter()
+        for a in approved:
+            puzzle = a.puzzle
+            verified[a.team_id] += 1
+            if a.puzzle_completed_at is not None and puzzle.enabled:
+                if puzzle.stream.enabled and puzzle.stream.default:
+                    main[a.team_id] += 1
+                stream_solves[(a.team_id, puzzle.stream_id)] += 1
+            if puzzle.last_puzzle_in_stream:
+                hints[a.team_id] += 1
+
+        # The flag is still set for renderers that only look at it, render_tree clears it
+        team_updates = {"invalidate_tree": True}
+        if dirty:
+            team_updates["tree_dirty_streams"] = Concat(
+                F("tree_dirty_streams"),
+                Case(*[When(pk=t, then=Value(_dirty_streams_value(streams))) for t, streams in dirty.items()],
+                     default=Value(""), output_field=models.TextField()))
+        for field, counts in (("scav_verified_solves", verified), ("scav_main_solves", main), ("free_hints", hints)):
+            if counts:
+                team_updates[field] = F(field) + Case(*[When(pk=t, then=Value(n)) for t, n in counts.items()],
+                                                      default=Value(0), output_field=models.IntegerField())
+        if touched:
+            md.Team.objects.filter(pk__in={team_id for team_id, _ in touched}).update(**team_updates)
+
+        if stream_solves:
+            TeamStreamProgress.record_solves(stream_solves)
 
 
 class TeamPuzzleActivity(models.Model):
@@ -148,6 +401,8 @@ class TeamPuzzleActivity(models.Model):
     team = models.ForeignKey(md.Team, on_delete=CASCADE)
     puzzle = models.ForeignKey('Puzzle', on_delete=CASCADE)
     puzzle_start_at = models.DateTimeField(auto_now=True)
+    # Set once when unlocked, puzzle_start_at moves on every save, solve times are measured from this
+    puzzle_unlocked_at = models.DateTimeField(default=timezone.now, editable=False)
     puzzle_completed_at = models.DateTimeField(null=True, blank=True, default=None)
     verification_photo = models.ForeignKey(VerificationPhoto, on_delete=SET_NULL, null=True, blank=True, default=None)
     completed_bitmask = models.IntegerField(default=0)
@@ -159,13 +414,35 @@ class TeamPuzzleActivity(models.Model):
 
         unique_together = [["team", "puzzle"]]
 
+    @staticmethod
+    def unlock(grants: Iterable[Tuple[int, int]]) -> Set[Tuple[int, int]]:
+        """
+        Gives each (team id, puzzle id) an activity unless it already has one, returns the grants that were new.
+
+        One query finds the activities that already exist and one insert adds the rest, ignoring any created in the
+        meantime, so duplicates never raise and it is safe inside a transaction. A grant raced by a concurrent
+        unlock can be reported as new by both.
+        """
+
+        grants = set(grants)
+        if not grants:
+            return set()
+
+        existing = set(TeamPuzzleActivity.objects
+                       .filter(team__in={t for t, _ in grants}, puzzle__in={p for _, p in grants})
+                       .values_list("team", "puzzle"))
+        new = grants - existing
+        if new:
+            now = timezone.now()
+            TeamPuzzleActivity.objects.bulk_create(
+                [TeamPuzzleActivity(team_id=t, puzzle_id=p, puzzle_unlocked_at=now) for t, p in new],
+                ignore_conflicts=True)
+        return new
+
     @property
     def num_clues_finished(self) -> int:
-        activities = TeamPuzzleActivity.objects \
-                     .filter(puzzle__stream=self.puzzle.stream, team=self.team,
-                             puzzle__enabled=True, verification_photo__approved=True) \
-                     .exclude(puzzle_completed_at=None)
-        return len(activities)
+        return TeamStreamProgress.objects.filter(team=self.team_id, stream=self.puzzle.stream_id) \
+            .values_list("verified_solves", flat=True).first() or 0
 
     @property
     def num_clues_total(self) -> int:
@@ -204,48 +481,62 @@ class TeamPuzzleActivity(models.Model):
         return False
 
     def mark_completed(self) -> None:
+        if self._set_completed():
+            self.save(update_fields=["puzzle_completed_at"])
+            self._after_completed()
+
+    def _set_completed(self) -> bool:
+        """Sets the completion time without saving, returns False if the puzzle was already completed."""
 
         logger.info(f"Marking puzzle {self.puzzle} completed for team {self.team}")
 
         if self.puzzle_completed_at:
             logger.warning(f"Puzzle {self.puzzle} already completed for team {self.team}")
-            return
+            return False
 
-        self.puzzle_completed_at = datetime.datetime.now()
-        self.save()
-        self.team.invalidate_tree = True
-        self.team.save()
+        self.puzzle_completed_at = timezone.now()
+        return True
+
+    def _after_completed(self) -> None:
+        md.Team.objects.filter(pk=self.team_id).update(
+            tree_dirty_streams=Concat(F("tree_dirty_streams"), Value(_dirty_streams_value([self.puzzle.stream_id]))),
+            invalidate_tree=True, scav_last_solve_at=self.puzzle_completed_at)
 
         logger.info(f"Puzzle {self.puzzle} marked as completed for team {self.team} at {self.puzzle_completed_at}")
 
     @property
     def completed_answers(self) -> bool:
-        answers = self.puzzle.answer.split(",")
-        comp = []
-        for i in range(0, 32):
-            mask = 1 << i
-            if self.completed_bitmask & mask:
-                comp += [answers[i]]
-        return comp
+        index = self.puzzle.answer_index
+        return [index.answers[i] for i in set_bits(self.completed_bitmask & index.full_mask)]
+
+    def _apply_answer(self, answer: str) -> Tuple[bool, bool]:
+        """Sets the bits for the answer without saving, returns (correct, all answers found)."""
+
+        index = self.puzzle.answer_index
+        mask = index.masks.get(normalize_answer(answer))
+        if mask is None:
+            return (False, (self.completed_bitmask & index.full_mask) == index.full_mask)
+        if self.completed_bitmask & mask:
+            return (False, False)
+        self.completed_bitmask |= mask
+        return (True, (self.completed_bitmask & index.full_mask) == index.full_mask)
 
     def complete_answer(self, answer: str) -> bool:
-        answers = self.puzzle.answer.split(",")
-        missing = False
-        correct = False
-        for i in range(len(answers)):
-            a = answers[i]
-            if answer.lower() == a.lower():
-                if self.completed_bitmask & (1 << i):
-                    return False
-                self.completed_bitmask |= 1 << i
-                self.save()
-                logger.info(f"Marking puzzle {self.puzzle}" +
-                            f"partially completed with answer {answer} for team {self.team}")
-                correct = True
-            if not self.completed_bitmask & (1 << i):
-                missing = True
-        if not missing:
-            self.mark_completed()
+        """Records the answer and completes the puzzle if it was the last one, saving with a single update."""
+
+        correct, finished = self._apply_answer(answer)
+        update_fields = []
+        if correct:
+            logger.info(f"Marking puzzle {self.puzzle}" +
+                        f"partially completed with answer {answer} for team {self.team}")
+            update_fields.append("completed_bitmask")
+        completed = finished and self._set_completed()
+        if completed:
+            update_fields.append("puzzle_completed_at")
+        if update_fields:
+            self.save(update_fields=update_fields)
+        if completed:
+            self._after_completed()
         return correct
 
     @property
@@ -269,9 +560,46 @@ class TeamPuzzleActivity(models.Model):
         return self._requires_verification_photo_upload()
 
 
+class TeamStreamProgress(models.Model):
+    """Count of a team's verified solves in a stream, kept up to date when photos are approved."""
+
+    team = models.ForeignKey(md.Team, on_delete=CASCADE)
+    stream = models.ForeignKey(PuzzleStream, on_delete=CASCADE)
+    verified_solves = models.IntegerField(default=0)
+    last_solve_at = models.DateTimeField(null=True, blank=True, default=None)
+
+    class Meta:
+        verbose_name = "Team Stream Progress"
+        verbose_name_plural = "Team Stream Progress"
+
+        unique_together = [["team", "stream"]]
+
+    @staticmethod
+    def record_solves(solves: Dict[Tuple[int, int], int]) -> None:
+        """Adds to the verified solves of each (team id, stream id), with one insert and one update."""
+
+        # Rows for first solves in a stream, another approval may be creating them at the same time
+        TeamStreamProgress.objects.bulk_create(
+            [TeamStreamProgress(team_id=team_id, stream_id=stream_id) for team_id, stream_id in solves],
+            ignore_conflicts=True)
+
+        rows = Q()
+        increments = []
+        for (team_id, stream_id), n in solves.items():
+            row = Q(team=team_id, stream=stream_id)
+            rows |= row
+            increments.append(When(row, then=Value(n)))
+        TeamStreamProgress.objects.filter(rows).update(
+            verified_solves=F("verified_solves") + Case(*increments, default=Value(0),
+                                                        output_field=models.IntegerField()),
+            last_solve_at=timezone.now())
+
+
 class QRCode(models.Model):
     puzzle = models.ForeignKey("Puzzle", on_delete=CASCADE)
     qr_code = models.ImageField(upload_to=md.scavenger_qr_code_path, blank=True, null=True)
+    # Of the URL, answer, style image and font the image was rendered from, it is stored under this name
+    digest = models.CharField(max_length=64, blank=True, default="", db_index=True)
 
     def __str__(self):
         return str(self.puzzle)
@@ -280,51 +608,106 @@ class QRCode(models.Model):
         verbose_name = "QR Code"
         verbose_name_plural = "QR Codes"
 
-    def generate_qr_code(self, answer: str) -> None:
-        url_base = md.Setting.objects.get_or_create(id="QR Code URL",
-                                                    defaults={"value": "https://server.engfrosh.com"})[0]
-
-        qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_H)
-        qr.add_data(
-            url_base.value + "/scavenger/puzzle/" + self.puzzle.secret_id + "?answer=" + answer)
-        qr.make(fit=True)
+    @staticmethod
+    def url_base() -> str:
+        return site_settings.QR_CODE_URL.get()
 
-        blob = BytesIO()
+    @staticmethod
+    def style() -> QRStyle:
+        """The style of puzzle QR codes, with the QR Code Image site image in the middle."""
 
         site_image = md.SiteImage.objects.filter(name="QR Code Image").first()
         if site_image and site_image.image:
-            STYLE_IMAGE_PATH = site_image.image.path
+            image_path = site_image.image.path
         else:
-            STYLE_IMAGE_PATH = "engfrosh_site/SpiritX.png"  # fallback
+            image_path = "engfrosh_site/SpiritX.png"  # fallback
+        return QRStyle(font_path=settings.STATICFILES_DIRS[0] + "/font.ttf", image_path=image_path, padding=25)
 
-        USE_IMAGE = True
-        if USE_IMAGE:
-            img = qr.make_image(image_factory=StyledPilImage, embeded_image_path=STYLE_IMAGE_PATH)
-        else:
-            img = qr.make_image()
-
-        orig_width = img.size[0]
-        height = img.size[1]
-        font = ImageFont.truetype(settings.STATICFILES_DIRS[0]+"/font.ttf", 40)
-        text_len = font.getlength(answer)
-        width = int(max(orig_width + 50, text_len + 50))
-        offset = 25
-        if text_len + 50 > orig_width:
-            offset = int((text_len + 50 - orig_width)/2)
-        with_text = Image.new(mode="RGB", size=(width, height + 50))
-        draw = ImageDraw.Draw(with_text)
-        draw.rectangle([(0, 0), with_text.size], fill=(255, 255, 255))
-        draw.rectangle([(offset, 0), (offset + img.width, img.height)], fill=(255, 255, 255))
-        with_text.paste(img._img, (offset, 0))  # This is a horrible hack, need to get the
-        # PIL image from a QRCode PIL image (diff library)
-        draw.text((width/2-text_len/2, height - 30),
-                  answer, align="center", fill=(0, 0, 0), font=font)
-
-        with_text.save(blob, "PNG")
-
-        self.qr_code.save("QRCode.png", File(blob))
+    @staticmethod
+    def puzzle_url(url_base: str, secret_id: str, answer: str) -> str:
+        return url_base + "/scavenger/puzzle/" + secret_id + "?answer=" + answer
+
+    @staticmethod
+    def digest_path(digest: str) -> str:
+        return md.SCAVENGER_DIR + md.QR_CODE_DIR + digest + ".png"
+
+    def generate_qr_code(self, answer: str) -> None:
+        url = QRCode.puzzle_url(QRCode.url_base(), self.puzzle.secret_id, answer)
+        style = QRCode.style()
+        self.digest = image_digest(url, answer, style_digest(style))
+        storage = self.qr_code.storage
+        name = QRCode.digest_path(self.digest)
+        if not storage.exists(name):
+            name = storage.save(name, ContentFile(render_png(url, answer, style)))
+        self.qr_code.name = name
         self.save()
 
+    @staticmethod
+    def generate_for_puzzles(puzzles: Iterable["Puzzle"], workers: Optional[int] = None,
+                             progress: Optional[Callable[[int, int], None]] = None) -> int:
+        """
+        Gives the puzzles one QR code per answer, returns the number of images that had to be rendered.
+
+        Images are stored under the digest of everything they are rendered from, so only those of new or changed
+        answers, URL base or style are rendered, in a process pool (see qr_render.render_many). Codes of answers
+        that are gone are deleted along with their images. progress is called with the number of images rendered
+        and the number to render after each one.
+        """
+
+        puzzles = list(puzzles)
+        url_base = QRCode.url_base()
+        style = QRCode.style()
+        style_key = style_digest(style)
+        storage = QRCode._meta.get_field("qr_code").storage
+
+        # (puzzle id, digest) to the data and label of the image
+        wanted: Dict[Tuple[int, str], Tuple[str, str]] = {}
+        for puzzle in puzzles:
+            for answer in puzzle.answers:
+                url = QRCode.puzzle_url(url_base, puzzle.secret_id, answer)
+                wanted[(puzzle.id, image_digest(url, answer, style_key))] = (url, answer)
+
+        existing = list(QRCode.objects.filter(puzzle__in=puzzles))
+        names = {c.digest: c.qr_code.name for c in existing if c.digest and c.qr_code}
+        to_render: Dict[str, Tuple[str, str]] = {}
+        for (_, digest), job in wanted.items():
+            if digest in names or digest in to_render:
+                continue
+            if storage.exists(QRCode.digest_path(digest)):
+                names[digest] = QRCode.digest_path(digest)
+            else:
+                to_render[digest] = job
+
+        rendered = list(to_render)
+        for i, (digest, png) in enumerate(zip(rendered, render_many(list(to_render.values()), style, workers)), 1):
+            names[digest] = storage.save(QRCode.digest_path(digest), ContentFile(png))
+            if progress is not None:
+                progress(i, len(rendered))
+
+        kept = set()
+        stale = []
+        for c in existing:
+            key = (c.puzzle_id, c.digest)
+            if key in wanted and key not in kept:
+                kept.add(key)
+            else:
+                stale.append(c)
+
+        with transaction.atomic():
+            QRCode.objects.filter(pk__in=[c.pk for c in stale]).delete()
+            QRCode.objects.bulk_create([QRCode(puzzle_id=puzzle_id, digest=digest, qr_code=names[digest])
+                                        for puzzle_id, digest in wanted if (puzzle_id, digest) not in kept])
+
+        # An image can be shared by codes outside the batch, it is only deleted once nothing refers to it
+        stale_names = {c.qr_code.name for c in stale if c.qr_code}
+        stale_names -= set(QRCode.objects.filter(qr_code__in=stale_names).values_list("qr_code", flat=True))
+        for name in stale_names:
+            storage.delete(name)
+
+        logger.info(f"Rendered {len(rendered)} and reused {len(wanted) - len(rendered)} QR codes "
+                    f"for {len(puzzles)} puzzles, deleted {len(stale)}")
+        return len(rendered)
+
 
 class Puzzle(models.Model):
     """Puzzles in scavenger"""
@@ -374,14 +757,37 @@ class Puzzle(models.Model):
 
     @property
     def last_puzzle_in_stream(self):
-        last = Puzzle.objects.filter(stream=self.stream).order_by('-order').first()
-        if last == self:
-            return True
-        return False
+        return PuzzleStream.order_of(self.stream_id).last_id == self.id
+
+    @property
+    def follow_on_puzzle_ids(self) -> List[int]:
+        """The puzzles a team gets once this one is verified: the branch it opens, its stream puzzle and the next."""
+
+        ids = []
+        if self.stream_branch_id is not None:
+            first_id = PuzzleStream.order_of(self.stream_branch_id).first_id
+            if first_id is not None:
+                ids.append(first_id)
+        if self.stream_puzzle_id is not None:
+            ids.append(self.stream_puzzle_id)
+        next_id = self.next_enabled_puzzle_id
+        if next_id is not None:
+            ids.append(next_id)
+        return ids
+
+    @property
+    def next_enabled_puzzle_id(self) -> Optional[int]:
+        """The id of the next enabled puzzle in the stream, None if this is the end of it."""
+        return PuzzleStream.order_of(self.stream_id).next_id(self.order)
 
     @property
     def answers(self):
-        return self.answer.split(",")
+        return list(self.answer_index.answers)
+
+    @property
+    def answer_index(self) -> AnswerIndex:
+        """Normalized answer to completed_bitmask lookup, rebuilt whenever the answer text changes."""
+        return answer_index(self.answer)
 
     def puzzle_activity_from_team(self, team: md.Team) -> Optional[TeamPuzzleActivity]:
         try:
@@ -430,64 +836,86 @@ class Puzzle(models.Model):
         """
         Checks if a team's guess is correct. First is if correct, second if stream complete,
         third the new puzzle if unlocked, fourth if a verification picture is required.
+        Raises ScavengerLockedOut if the puzzle's stream is locked out, unless bypassed.
 
         Will move team to next question if it is correct or complete scavenger if appropriate.
+        The whole guess runs in one transaction with the team's activity locked, so concurrent
+        guesses from the same team are applied one after the other.
         """
 
         logger.info(f"Checking team guess for team {team} with guess: {guess}")
 
-        activity = TeamPuzzleActivity.objects.get(team=team.id, puzzle=self.id)
-        logger.info(f"Got current puzzle activity for team {team}: {activity}")
         if len(guess) > 100:
             # Longer string than model holds
-            logger.warn("Team's guess is longer than allowed")
+            logger.warning("Team's guess is longer than allowed")
             return (False, False, None, False)
-        # Create a guess object
-        pg = PuzzleGuess(value=guess, activity=activity)
-        pg.save()
-        logger.info(f"Saved puzzle guess for team {team} on puzzle {self}: {pg}")
 
-        # Check the answer
-        correct = activity.complete_answer(guess)
+        if not bypass and md.LockoutPeriod.is_locked(self.stream_id):
+            logger.info(f"Team {team} guessed on puzzle {self} while its stream is locked out")
+            raise ScavengerLockedOut(f"The stream of puzzle {self} is locked out")
+
+        with transaction.atomic():
+            activity = TeamPuzzleActivity.objects.select_for_update().get(team=team.pk, puzzle=self.pk)
+            # Reuse the instances we already have instead of lazy loading them again
+            activity.team = team
+            activity.puzzle = self
+            logger.info(f"Got current puzzle activity for team {team}: {activity}")
+
+            # Check the answer
+            was_completed = activity.puzzle_completed_at is not None
+            correct = activity.complete_answer(guess)
+
+            # Logged off the critical path, with other guesses
+            PuzzleGuess.record(activity, guess, not was_completed and activity.puzzle_completed_at is not None)
+
+            if not correct:
+                answer = self.answer.lower()
+                logger.info(f"Team {team} guess {guess} is not the answer to puzzle {self}, {answer}")
+                return (correct, False, None, False)
+
+            # Mark the question as correct
+            logger.info(f"Team {team} guess {guess} is correct for puzzle {self}")
+
+            if activity.is_completed:
+
+                # If verification is required,
+                if self.require_photo_upload and not bypass:
+                    message = f"{team.display_name} has completed question {self.name}, awaiting a photo upload."
+                    result = (correct, False, None, True)
+                else:
+                    photo = VerificationPhoto.objects.create(approved=False, photo=None)
+                    activity.verification_photo = photo
+                    activity.save(update_fields=["verification_photo"])
+                    next_id = photo._approve(activity)
+                    next_puzzle = Puzzle.objects.get(pk=next_id) if next_id is not None else None
+                    message = f"{team.display_name} has completed question {self.name}, no photo upload required."
+                    result = (correct, False, next_puzzle, False)
+            else:
+                message = f"{team.display_name} has partially completed puzzle {self.name} with {guess}"
+                result = (True, False, self, False)
 
-        if not correct:
-            answer = self.answer.lower()
-            logger.info(f"Team {team} guess {guess} is not the answer to puzzle {self}, {answer}")
-            return (correct, False, None, False)
+            # Sent by the outbox dispatcher, the guess never waits on discord
+            md.DiscordChannel.queue_to_tag("SCAVENGER_MANAGEMENT_UPDATES_CHANNEL", message)
 
-        # Mark the question as correct
-        logger.info(f"Team {team} guess {guess} is correct for puzzle {self}")
+        team._clear_scavenger_snapshot()
 
-        md.ChannelTag.objects.get_or_create(name="SCAVENGER_MANAGEMENT_UPDATES_CHANNEL")
-        discord_channels = md.DiscordChannel.objects.filter(tags__name="SCAVENGER_MANAGEMENT_UPDATES_CHANNEL")
+        return result
 
-        if activity.is_completed:
+    def _generate_qr_code(self) -> None:
+        QRCode.generate_for_puzzles([self], workers=1)
 
-            # If verification is required,
-            if self.require_photo_upload and not bypass:
-                for ch in discord_channels:
-                    ch.send(f"{team.display_name} has completed question {self.name}, awaiting a photo upload.")
 
-                return (correct, False, None, True)
-            else:
-                photo = VerificationPhoto(approved=False, photo=None)
-                photo.save()
-                activity.verification_photo = photo
-                activity.save()
-                photo.approve()
-                for ch in discord_channels:
-                    ch.send(f"{team.display_name} has completed question {self.name}, no photo upload required.")
-                next_puzzle = self.stream.get_next_enabled_puzzle(self)
-                return (correct, False, next_puzzle, False)
-        else:
-            for ch in discord_channels:
-                ch.send(f"{team.display_name} has partially completed puzzle {self.name} with {guess}")
-            return (True, False, self, False)
+@receiver([post_save, post_delete], sender=Puzzle)
+@receiver([post_save, post_delete], sender=PuzzleStream)
+def _invalidate_stream_index(sender, **kwargs) -> None:
+    _stream_index.invalidate()
 
-    def _generate_qr_code(self) -> None:
-        codes = QRCode.objects.filter(puzzle=self)
-        for qr in codes:
-            qr.delete()
-        for a in self.answer.split(","):
-            qr = QRCode(puzzle=self)
-            qr.generate_qr_code(a)
+
+@receiver([post_save, post_delete], sender=LockoutPeriod)
+def _invalidate_lockout_intervals(sender, **kwargs) -> None:
+    _lockout_intervals.invalidate()
+
+
+@receiver(request_finished)
+def _flush_due_guesses(sender, **kwargs) -> None:
+    _guess_buffer.flush_if_due()
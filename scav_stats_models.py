@@ -0,0 +1,225 @@
+"""
+Per-puzzle guess and solve statistics, kept up to date as the buffered guesses are inserted.
+
+Organizers look at these during the event to find stuck puzzles, so they are read from small indexed tables rather
+than by scanning PuzzleGuess.
+"""
+
+from bisect import bisect_left
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.apps import apps as django_apps
+from django.apps.registry import Apps
+from django.db import models, transaction
+from django.db.models import Case, Count, F, Q, Value, When
+from django.db.models.deletion import CASCADE
+
+import common_models.models as md
+from common_models.scav_answers import answer_index, normalize_answer
+
+# Upper bounds in seconds of the solve time histogram buckets, the last bucket holds everything slower
+SOLVE_TIME_BUCKETS = (30, 60, 120, 180, 300, 450, 600, 900, 1200, 1800, 2700, 3600, 5400, 7200, 10800, 14400,
+                      21600, 43200, 86400)
+
+
+def solve_time_bucket(seconds: float) -> int:
+    return bisect_left(SOLVE_TIME_BUCKETS, seconds)
+
+
+def _increments(field: str, keys: Dict[Q, int]) -> F:
+    return F(field) + Case(*[When(q, then=Value(n)) for q, n in keys.items()],
+                           default=Value(0), output_field=models.IntegerField())
+
+
+class PuzzleGuessStats(models.Model):
+    """Guess and solve totals of a puzzle."""
+
+    puzzle = models.OneToOneField("Puzzle", on_delete=CASCADE, primary_key=True, related_name="guess_stats")
+    guesses = models.IntegerField(default=0)
+    wrong_guesses = models.IntegerField(default=0)
+    solves = models.IntegerField(default=0)
+    total_solve_seconds = models.BigIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Puzzle Guess Stats"
+        verbose_name_plural = "Puzzle Guess Stats"
+
+    def __str__(self) -> str:
+        return f"{self.puzzle}: {self.wrong_guesses}/{self.guesses} wrong, {self.solves} solves"
+
+    @property
+    def mean_solve_seconds(self) -> Optional[float]:
+        if not self.solves:
+            return None
+        return self.total_solve_seconds / self.solves
+
+    @property
+    def top_wrong_answers(self) -> List[Tuple[str, int]]:
+        return PuzzleWrongAnswer.top_for_puzzle(self.puzzle_id)
+
+    def solve_time_percentiles(self, percentiles: Iterable[float] = (0.5, 0.9)) -> Dict[float, Optional[int]]:
+        return PuzzleSolveTimeBucket.percentiles(self.puzzle_id, percentiles)
+
+    @staticmethod
+    def record_guesses(guesses: List["md.PuzzleGuess"]) -> None:
+        """
+        Adds the guesses, just inserted, to the statistics of their puzzles with an insert and an update per table.
+
+        A guess is wrong unless it is one of the puzzle's answers, as rebuild classifies them, and solves are
+        counted from the guesses that completed their puzzle. The guesses need their activity and its puzzle loaded,
+        which they are when recorded by check_team_guess.
+        """
+
+        totals: Dict[int, Counter] = {}
+        wrong: Counter = Counter()
+        buckets: Counter = Counter()
+        for guess in guesses:
+            activity = guess.activity
+            puzzle_id = activity.puzzle_id
+            counts = totals.setdefault(puzzle_id, Counter())
+            counts["guesses"] += 1
+            if not guess.correct:
+                counts["wrong_guesses"] += 1
+                wrong[(puzzle_id, normalize_answer(guess.value))] += 1
+            if getattr(guess, "completed_puzzle", False):
+                seconds = max(0, int((activity.puzzle_completed_at - activity.puzzle_unlocked_at).total_seconds()))
+                counts["solves"] += 1
+                counts["total_solve_seconds"] += seconds
+                buckets[(puzzle_id, solve_time_bucket(seconds))] += 1
+        if not totals:
+            return
+
+        with transaction.atomic():
+            PuzzleGuessStats.objects.bulk_create([PuzzleGuessStats(puzzle_id=p) for p in totals],
+                                                 ignore_conflicts=True)
+            updates = {}
+            for field in ("guesses", "wrong_guesses", "solves", "total_solve_seconds"):
+                keys = {Q(pk=p): counts[field] for p, counts in totals.items() if counts[field]}
+                if keys:
+                    updates[field] = _increments(field, keys)
+            PuzzleGuessStats.objects.filter(pk__in=totals).update(**updates)
+
+            if wrong:
+                PuzzleWrongAnswer.objects.bulk_create([PuzzleWrongAnswer(puzzle_id=p, value=v) for p, v in wrong],
+                                                      ignore_conflicts=True)
+                keys = {Q(puzzle=p, value=v): n for (p, v), n in wrong.items()}
+                PuzzleWrongAnswer.objects.filter(Q(*keys, _connector=Q.OR)).update(count=_increments("count", keys))
+
+            if buckets:
+                PuzzleSolveTimeBucket.objects.bulk_create(
+                    [PuzzleSolveTimeBucket(puzzle_id=p, bucket=b) for p, b in buckets], ignore_conflicts=True)
+                keys = {Q(puzzle=p, bucket=b): n for (p, b), n in buckets.items()}
+                PuzzleSolveTimeBucket.objects.filter(Q(*keys, _connector=Q.OR)) \
+                    .update(count=_increments("count", keys))
+
+    @staticmethod
+    def rebuild(apps: Optional[Apps] = None) -> None:
+        """
+        Recomputes every puzzle's statistics from the guesses and activities.
+
+        Guesses are classified against the puzzles' current answers with their normalized answer index, the same
+        way record_guesses classifies them, and solves are counted from the completed activities, timed from when
+        they were unlocked. Migrations pass their apps so that the historical models are used.
+        """
+
+        if apps is None:
+            apps = django_apps
+        names = ("Puzzle", "PuzzleGuess", "TeamPuzzleActivity", "PuzzleGuessStats", "PuzzleWrongAnswer",
+                 "PuzzleSolveTimeBucket")
+        Puzzle, PuzzleGuess, TeamPuzzleActivity, GuessStats, WrongAnswer, SolveTimeBucket = (
+            apps.get_model("common_models", name) for name in names)
+
+        answers = dict(Puzzle.objects.values_list("id", "answer"))
+        totals: Dict[int, Counter] = {}
+        wrong: Counter = Counter()
+        for puzzle_id, value, n in PuzzleGuess.objects.order_by() \
+                .values_list("activity__puzzle", "value").annotate(n=Count("pk")):
+            counts = totals.setdefault(puzzle_id, Counter())
+            counts["guesses"] += n
+            if normalize_answer(value) not in answer_index(answers[puzzle_id]).masks:
+                counts["wrong_guesses"] += n
+                wrong[(puzzle_id, normalize_answer(value))] += n
+
+        buckets: Counter = Counter()
+        for puzzle_id, unlocked, completed in TeamPuzzleActivity.objects.exclude(puzzle_completed_at=None) \
+                .values_list("puzzle", "puzzle_unlocked_at", "puzzle_completed_at").iterator():
+            seconds = max(0, int((completed - unlocked).total_seconds()))
+            counts = totals.setdefault(puzzle_id, Counter())
+            counts["solves"] += 1
+            counts["total_solve_seconds"] += seconds
+            buckets[(puzzle_id, solve_time_bucket(seconds))] += 1
+
+        with transaction.atomic():
+            GuessStats.objects.all().delete()
+            WrongAnswer.objects.all().delete()
+            SolveTimeBucket.objects.all().delete()
+            GuessStats.objects.bulk_create([GuessStats(puzzle_id=p, **counts) for p, counts in totals.items()])
+            WrongAnswer.objects.bulk_create([WrongAnswer(puzzle_id=p, value=v, count=n)
+                                             for (p, v), n in wrong.items()], batch_size=1000)
+            SolveTimeBucket.objects.bulk_create([SolveTimeBucket(puzzle_id=p, bucket=b, count=n)
+                                                 for (p, b), n in buckets.items()])
+
+
+class PuzzleWrongAnswer(models.Model):
+    """How many times a wrong answer, normalized, was guessed for a puzzle."""
+
+    puzzle = models.ForeignKey("Puzzle", on_delete=CASCADE)
+    value = models.CharField(max_length=100)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Puzzle Wrong Answer"
+        verbose_name_plural = "Puzzle Wrong Answers"
+
+        unique_together = [["puzzle", "value"]]
+        indexes = [
+            models.Index(fields=["puzzle", "-count"], name="puzzle_wrong_answer_top_idx"),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.puzzle}: {self.value} ({self.count})"
+
+    @staticmethod
+    def top_for_puzzle(puzzle_id: int, limit: int = 10) -> List[Tuple[str, int]]:
+        """The most common wrong answers to the puzzle with their counts, most common first."""
+
+        return list(PuzzleWrongAnswer.objects.filter(puzzle=puzzle_id).order_by("-count", "value")
+                    .values_list("value", "count")[:limit])
+
+
+class PuzzleSolveTimeBucket(models.Model):
+    """How many teams solved a puzzle within a bucket of SOLVE_TIME_BUCKETS of it being unlocked."""
+
+    puzzle = models.ForeignKey("Puzzle", on_delete=CASCADE)
+    bucket = models.SmallIntegerField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Puzzle Solve Time Bucket"
+        verbose_name_plural = "Puzzle Solve Time Buckets"
+
+        unique_together = [["puzzle", "bucket"]]
+
+    @staticmethod
+    def percentiles(puzzle_id: int, percentiles: Iterable[float] = (0.5, 0.9)) -> Dict[float, Optional[int]]:
+        """
+        The solve time in seconds under which each fraction of the solves fall, to the upper bound of its bucket.
+
+        None for percentiles that fall in the last, unbounded, bucket and for all of them if nobody solved it.
+        """
+
+        counts = dict(PuzzleSolveTimeBucket.objects.filter(puzzle=puzzle_id).values_list("bucket", "count"))
+        total = sum(counts.values())
+        result: Dict[float, Optional[int]] = {}
+        for p in percentiles:
+            result[p] = None
+            if not total:
+                continue
+            seen = 0
+            for bucket in range(len(SOLVE_TIME_BUCKETS) + 1):
+                seen += counts.get(bucket, 0)
+                if seen >= p * total:
+                    result[p] = SOLVE_TIME_BUCKETS[bucket] if bucket < len(SOLVE_TIME_BUCKETS) else None
+                    break
+        return result
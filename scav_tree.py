@@ -0,0 +1,123 @@
+"""
+A team's scavenger progress tree, cached as JSON in Team.tree_cache and re-rendered a stream at a time.
+
+Completions and approvals append the streams they touch to Team.tree_dirty_streams. Rendering loads the
+activities of only those streams, swaps them into the cached tree and clears the streams it rendered, so a
+solve costs one stream's worth of work however many times the tree is viewed afterwards. An unreadable cache, any
+change to the puzzles or streams and Team.invalidate_tree set with no dirty streams re-render the whole tree.
+
+Completions and approvals also still set Team.invalidate_tree, for renderers that only look at the flag. Rendering
+clears it once no streams are left dirty.
+"""
+
+import json
+import logging
+from typing import Dict, Iterable, Optional, Set
+
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Substr
+
+import common_models.models as md
+from common_models.scav_progress import ScavengerSnapshot
+
+logger = logging.getLogger("common_models.scav_tree")
+
+TREE_FORMAT = 1
+
+
+def dirty_stream_ids(value: str) -> Set[int]:
+    """The streams listed in a Team.tree_dirty_streams value."""
+
+    return {int(s) for s in value.split(",") if s}
+
+
+def node_status(activity) -> str:
+    if activity.is_verified:
+        return "verified"
+    if activity.is_awaiting_verification:
+        return "awaiting_verification"
+    if activity.requires_verification_photo_upload:
+        return "photo_required"
+    if activity.is_completed:
+        return "completed"
+    return "active"
+
+
+def render_streams(snapshot: ScavengerSnapshot) -> Dict[str, dict]:
+    """The tree of every stream in the snapshot, keyed by the stream id as a string like it is in JSON."""
+
+    streams: Dict[str, dict] = {}
+    for a in snapshot.activities:
+        puzzle = a.puzzle
+        stream = streams.get(str(puzzle.stream_id))
+        if stream is None:
+            stream = streams[str(puzzle.stream_id)] = {
+                "name": puzzle.stream.name,
+                "enabled": puzzle.stream.enabled,
+                "locked": puzzle.stream.locked,
+                "nodes": [],
+            }
+        # Activities come in puzzle order, so the nodes do too
+        stream["nodes"].append({
+            "id": puzzle.id,
+            "name": puzzle.name,
+            "order": str(puzzle.order),
+            "status": node_status(a),
+            "opens_stream": puzzle.stream_branch_id,
+            "opens_puzzle": puzzle.stream_puzzle_id,
+        })
+    return streams
+
+
+def _parse(tree_cache: str, structure: str) -> Optional[dict]:
+    """The cached tree if it can be updated in place, None if it has to be rendered from scratch."""
+
+    try:
+        tree = json.loads(tree_cache)
+    except ValueError:
+        return None
+    if not isinstance(tree, dict) or tree.get("format") != TREE_FORMAT or tree.get("structure") != structure:
+        return None
+    return tree
+
+
+def _render(team: "md.Team", tree: Optional[dict], stream_ids: Optional[Iterable[int]], structure: str) -> dict:
+    if tree is None:
+        return {"format": TREE_FORMAT, "structure": structure,
+                "streams": render_streams(ScavengerSnapshot.for_team(team))}
+
+    stream_ids = set(stream_ids)
+    streams = {s: stream for s, stream in tree["streams"].items() if int(s) not in stream_ids}
+    streams.update(render_streams(ScavengerSnapshot.for_team(team, stream_ids)))
+    return {"format": TREE_FORMAT, "structure": structure, "streams": streams}
+
+
+def render_tree(team: "md.Team") -> dict:
+    """
+    The team's tree, from the cache when nothing changed since it was rendered.
+
+    Costs one query when the cache is current and three when streams have to be re-rendered.
+    """
+
+    row = md.Team.objects.filter(pk=team.pk).values("invalidate_tree", "tree_cache", "tree_dirty_streams").get()
+    structure = md.PuzzleStream.structure_version()
+    dirty = row["tree_dirty_streams"]
+
+    tree = None if row["invalidate_tree"] and not dirty else _parse(row["tree_cache"], structure)
+    if tree is not None and not dirty:
+        return tree
+
+    if tree is None:
+        logger.info(f"Rendering the whole scavenger tree for team {team}")
+    tree = _render(team, tree, dirty_stream_ids(dirty), structure)
+    tree_cache = json.dumps(tree)
+
+    # Streams are only ever appended, those marked while rendering stay for the next render and keep the flag set.
+    # A reset while updating the tree in place clears the dirty streams and leaves it unsaved, it is still returned.
+    saved = md.Team.objects.filter(pk=team.pk, tree_dirty_streams__startswith=dirty) \
+        .update(tree_cache=tree_cache,
+                invalidate_tree=Case(When(tree_dirty_streams=dirty, then=Value(False)), default=Value(True)),
+                tree_dirty_streams=Substr(F("tree_dirty_streams"), len(dirty) + 1))
+    if saved:
+        team.tree_cache = tree_cache
+    return tree
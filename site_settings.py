@@ -0,0 +1,112 @@
+"""
+The settings organizers change through BooleanSetting and Setting, declared with their types and defaults.
+
+Every declared setting is read from one process local copy of both tables, rebuilt when either changes, so reading
+a setting in a loop does not query the database. seed_settings inserts the rows of the declared settings that are
+missing, it runs after every migrate rather than on every read.
+"""
+
+import copy
+import logging
+from typing import Any, Callable, Dict, Generic, List, Tuple, TypeVar
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+import common_models.models as md
+from common_models.caching import VersionedCache
+
+logger = logging.getLogger("common_models.site_settings")
+
+T = TypeVar("T")
+
+_registry: Dict[Tuple[bool, str], "DeclaredSetting"] = {}
+
+
+def _comma_list(value: str) -> List[str]:
+    return value.split(",")
+
+
+class DeclaredSetting(Generic[T]):
+    """
+    A setting stored in a BooleanSetting when boolean, otherwise as text in a Setting.
+
+    parse turns the text into the setting's type and format turns a value back into text. The default is used when
+    the row is missing or its value cannot be parsed.
+    """
+
+    def __init__(self, id: str, default: T, parse: Callable[[str], T] = str, format: Callable[[T], str] = str,
+                 boolean: bool = False) -> None:
+        self.id = id
+        self.default = default
+        self.parse = parse
+        self.format = format
+        self.boolean = boolean
+        _registry[(boolean, id)] = self
+
+    def __repr__(self) -> str:
+        return f"DeclaredSetting({self.id!r})"
+
+    def get(self) -> T:
+        value = _settings.get().get((self.boolean, self.id), self.default)
+        # The value is shared by the whole process, changing a list or dict read from it must not change the setting
+        if isinstance(value, (list, dict)):
+            return copy.deepcopy(value)
+        return value
+
+    def _parse(self, value: Any) -> T:
+        if self.boolean:
+            return value
+        if value is None:
+            return self.default
+        try:
+            return self.parse(value)
+        except ValueError:
+            logger.warning(f"Could not parse setting {self.id} from {value!r}, using {self.default!r}")
+            return self.default
+
+
+def boolean_setting(id: str, default: bool = True) -> DeclaredSetting[bool]:
+    return DeclaredSetting(id, default, boolean=True)
+
+
+SCAVENGER_ENABLED = boolean_setting("SCAVENGER_ENABLED")
+TRADE_UP_ENABLED = boolean_setting("TRADE_UP_ENABLED")
+DISCORD_ENABLED = boolean_setting("DISCORD_ENABLED")
+REGISTRATION_ENABLED = boolean_setting("REGISTRATION_ENABLED", False)
+DISCORD_LOGIN_ENABLED = boolean_setting("DISCORD_LOGIN_ENABLED")
+
+MAX_FACIL_SHIFTS = DeclaredSetting("MAX_FACIL_SHIFTS", 2, int)
+# In seconds before the shift starts, defaults to 72h
+FACIL_SHIFT_CUTOFF = DeclaredSetting("Facil Shift Cutoff", 259200, int)
+FROSH_CHECKIN_REQ = DeclaredSetting("Frosh_Checkin_Req", ["waiver"], _comma_list, ",".join)
+FACIL_CHECKIN_REQ = DeclaredSetting("Facil_Checkin_Req", ["waiver", "brightspace", "prc", "contract", "paid"],
+                                    _comma_list, ",".join)
+QR_CODE_URL = DeclaredSetting("QR Code URL", "https://server.engfrosh.com")
+
+
+def _load_settings() -> Dict[Tuple[bool, str], Any]:
+    rows = [((True, id), value) for id, value in md.BooleanSetting.objects.values_list("id", "value")]
+    rows += [((False, id), value) for id, value in md.Setting.objects.values_list("id", "value")]
+    return {key: _registry[key]._parse(value) for key, value in rows if key in _registry}
+
+
+_settings = VersionedCache("site_settings", _load_settings)
+
+
+def seed_settings() -> None:
+    """Inserts the declared settings that have no row yet with their defaults, leaving the others as they are."""
+
+    md.BooleanSetting.objects.bulk_create(
+        [md.BooleanSetting(id=s.id, value=s.default) for s in _registry.values() if s.boolean],
+        ignore_conflicts=True)
+    md.Setting.objects.bulk_create(
+        [md.Setting(id=s.id, value=s.format(s.default)) for s in _registry.values() if not s.boolean],
+        ignore_conflicts=True)
+    _settings.invalidate()
+
+
+@receiver([post_save, post_delete], sender="common_models.BooleanSetting")
+@receiver([post_save, post_delete], sender="common_models.Setting")
+def _invalidate_settings(sender, **kwargs) -> None:
+    _settings.invalidate()
@@ -1,15 +1,39 @@
-from django.db import models
+from django.db import models, transaction
+from django.core.cache import cache
+from django.db.models import Count, F, OuterRef, Q, Subquery, Value
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 import datetime
 import logging
 from django.db.models.deletion import CASCADE
-from typing import List, Optional
+from typing import Dict, Iterable, List, Optional
 from django.contrib.auth.models import User, Group
 
 import common_models.models as md
+from common_models import site_settings
+from common_models.scav_progress import ScavengerSnapshot
+from common_models.scav_tree import render_tree
 
 logger = logging.getLogger("common_models.teams_models")
 
+# A backstop, the cache is cleared as group memberships and teams change
+USER_TEAM_CACHE_TIMEOUT = 3600
+
+
+def _user_team_key(user_id: int) -> str:
+    return f"common_models:user_team:{user_id}"
+
+
+def _forget_user_teams(user_ids: Iterable[int]) -> None:
+    """Forgets the users' cached teams, now and again once the current transaction commits."""
+
+    keys = [_user_team_key(u) for u in user_ids]
+    cache.delete_many(keys)
+    # A lookup before the commit would otherwise cache the old team again
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
 
 class VirtualTeam(models.Model):
     """Tracks Virtual Teams and their discord ids."""
@@ -35,6 +59,17 @@ class TeamRoom(models.Model):
     class Meta:
         verbose_name = "Team Room"
         verbose_name_plural = "Team Rooms"
+        indexes = [
+            models.Index(fields=["team", "date"], name="teamroom_team_date_idx"),
+            models.Index(fields=["date"], name="teamroom_date_idx"),
+        ]
+
+    @staticmethod
+    def room_for(team_id: int, date: datetime.date) -> Optional[str]:
+        """The team's room on the date, None if it has none scheduled."""
+
+        return TeamRoom.objects.filter(team=team_id, date=date).order_by("pk") \
+            .values_list("room", flat=True).first()
 
 
 class Team(models.Model):
@@ -63,6 +98,13 @@ class Team(models.Model):
     _room = models.CharField("Room Number", max_length=64, blank=True, null=True)
     invalidate_tree = models.BooleanField(default=True)
     tree_cache = models.TextField(default="")
+    # Streams changed since the tree was rendered, each id followed by a comma, see scav_tree
+    tree_dirty_streams = models.TextField(default="", blank=True)
+
+    # Kept up to date on completion and approval, rebuild_solve_counters recomputes them from the activities
+    scav_verified_solves = models.IntegerField("Verified Solves", default=0)
+    scav_main_solves = models.IntegerField("Main Stream Solves", default=0)
+    scav_last_solve_at = models.DateTimeField("Last Solve", null=True, blank=True, default=None)
 
     class Meta:
         verbose_name = "Team"
@@ -71,125 +113,281 @@ class Team(models.Model):
             ("change_team_coin", "Can change the coin amount of a team."),
             ("view_team_coin_standings", "Can view the coin standings of all teams.")
         ]
+        indexes = [
+            models.Index(fields=["-scav_main_solves", "scav_last_solve_at"], name="team_scav_leaderboard_idx"),
+        ]
+
+    # Only changed by update() as solves are recorded and approved, a full save of an instance loaded before a solve
+    # leaves them
+    SQL_MAINTAINED_FIELDS = ("scav_verified_solves", "scav_main_solves", "scav_last_solve_at", "tree_dirty_streams",
+                             "free_hints")
+
+    # The keys of to_dict and the column each is read from
+    SERIALIZED_FIELDS = {
+        "team_id": "group",
+        "team_name": "display_name",
+        "coin_amount": "coin_amount",
+        "color_number": "color",
+        "color_code": "color",
+    }
 
     def __str__(self):
         return str(self.display_name)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        team = super().from_db(db, field_names, values)
+        # The balance when loaded, so that save can apply a change to it rather than overwrite it
+        team._loaded_coin_amount = team.__dict__.get("coin_amount")
+        return team
+
+    def save(self, *args, **kwargs) -> None:
+        opening, coins = 0, None
+        adding = self._state.adding
+        if adding:
+            # Recorded without an increment, the insert already sets the balance
+            opening = self.coin_amount
+        elif not args:
+            update_fields = kwargs.get("update_fields")
+            if update_fields is None:
+                deferred = self.get_deferred_fields()
+                update_fields = [f.name for f in self._meta.concrete_fields
+                                 if not f.primary_key and f.name not in Team.SQL_MAINTAINED_FIELDS
+                                 and f.attname not in deferred]
+            loaded = getattr(self, "_loaded_coin_amount", None)
+            if loaded is not None and "coin_amount" in update_fields:
+                # Writing the balance back would lose the awards made since it was loaded
+                update_fields = [f for f in update_fields if f != "coin_amount"]
+                coins = self.coin_amount - loaded
+            kwargs["update_fields"] = update_fields
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if opening:
+                md.CoinTransaction.objects.create(team=self, amount=opening, reason="Opening balance")
+            if coins:
+                md.CoinTransaction.award(self.pk, coins, "Changed on the team")
+        if adding or coins is not None:
+            self._loaded_coin_amount = self.coin_amount
+
     @property
     def room(self):
-        rooms = TeamRoom.objects.filter(team=self)
-        today = datetime.date.today()
-        for room in rooms:
-            if room.date == today:
-                return room.room
-        return self._room
+        room = TeamRoom.room_for(self.pk, datetime.date.today())
+        if room is None:
+            return self._room
+        return room
+
+    @staticmethod
+    def rooms_on(date: Optional[datetime.date] = None) -> Dict[int, Optional[str]]:
+        """
+        The room of every team on the date, today by default, with one query.
+
+        Teams with no room scheduled that day have their default room, as Team.room does.
+        """
+
+        if date is None:
+            date = datetime.date.today()
+        scheduled = TeamRoom.objects.filter(team=OuterRef("pk"), date=date).order_by("pk").values("room")[:1]
+        return {team_id: room if room is not None else default
+                for team_id, room, default in Team.objects.annotate(scheduled_room=Subquery(scheduled))
+                .values_list("pk", "scheduled_room", "_room")}
 
     @staticmethod
     def from_user(user: User) -> Optional:
-        teams = Team.objects.filter(group__in=user.groups.all())
-        if not teams:
+        """
+        The user's team, None if they are not on one or are anonymous. Costs at most a primary key lookup once cached.
+        """
+
+        team_id = Team.team_id_of_user(user.pk)
+        if team_id is None:
             return None
-        return teams[0]
+        return Team.objects.filter(pk=team_id).first()
+
+    @staticmethod
+    def team_id_of_user(user_id: Optional[int]) -> Optional[int]:
+        """The id of the user's team, cached until their groups or the teams change, None for anonymous users."""
+
+        if user_id is None:
+            # Filtering on a None user would match the teams without members
+            return None
+        team_id = cache.get(_user_team_key(user_id))
+        if team_id is None:
+            team_id = Team.objects.filter(group__user=user_id).order_by("pk").values_list("pk", flat=True).first()
+            # None can't be told apart from a miss, so no team is cached as 0
+            team_id = team_id or 0
+            cache.set(_user_team_key(user_id), team_id, USER_TEAM_CACHE_TIMEOUT)
+        return team_id or None
+
+    @staticmethod
+    def for_users(user_ids: Iterable[int]) -> Dict[int, Optional["Team"]]:
+        """The team of each of the users, None for those not on one, with one query, refreshing their cache."""
+
+        user_ids = set(user_ids) - {None}
+        teams: Dict[int, Optional[Team]] = dict.fromkeys(user_ids)
+        for team in Team.objects.filter(group__user__in=user_ids).annotate(member_id=F("group__user")) \
+                .order_by("-pk"):
+            # Ordered so a user in more than one team gets the first, like team_id_of_user
+            teams[team.member_id] = team
+        cache.set_many({_user_team_key(u): t.pk if t is not None else 0 for u, t in teams.items()},
+                       USER_TEAM_CACHE_TIMEOUT)
+        return teams
 
     @property
     def id(self) -> int:
         return self.group.id
 
+    def scavenger_snapshot(self) -> ScavengerSnapshot:
+        """All of the team's scavenger progress from one query, kept until the team is refreshed."""
+
+        snapshot = getattr(self, "_scavenger_snapshot", None)
+        if snapshot is None:
+            snapshot = ScavengerSnapshot.for_team(self)
+            self._scavenger_snapshot = snapshot
+        return snapshot
+
+    def _clear_scavenger_snapshot(self) -> None:
+        self._scavenger_snapshot = None
+
+    def refresh_from_db(self, *args, **kwargs) -> None:
+        self._clear_scavenger_snapshot()
+        super().refresh_from_db(*args, **kwargs)
+        fields = kwargs.get("fields", args[1] if len(args) > 1 else None)
+        if fields is None or "coin_amount" in fields:
+            self._loaded_coin_amount = self.__dict__.get("coin_amount")
+
     @property
     def num_clues_finished(self) -> int:
-        return len(self.verified_puzzles)
+        return self.scav_verified_solves
 
     @property
     def num_main_clues_finished(self) -> int:
-        main_streams = md.PuzzleStream.objects.filter(enabled=True, default=True)
-        activities = md.TeamPuzzleActivity.objects \
-            .filter(puzzle__stream__in=main_streams, team=self,
-                    puzzle__enabled=True, verification_photo__approved=True) \
-            .exclude(puzzle_completed_at=None)
-        return len(activities)
+        return self.scav_main_solves
 
     @property
     def last_puzzle_timestamp(self) -> str:
-        activity = md.TeamPuzzleActivity.objects.filter(team=self).exclude(puzzle_completed_at=None)
-        activity = activity.order_by("-puzzle_completed_at").first()
-        if activity is None:
+        if self.scav_last_solve_at is None:
             return "N/A"
-        return str(activity.puzzle_completed_at)
+        return str(self.scav_last_solve_at)
+
+    @staticmethod
+    def leaderboard() -> models.QuerySet:
+        """Scavenger teams by main stream solves, ties going to the team that got there first."""
+
+        return Team.objects.filter(scavenger_team=True).order_by("-scav_main_solves", "scav_last_solve_at")
+
+    @staticmethod
+    def rebuild_solve_counters(teams: Optional[models.QuerySet] = None) -> None:
+        """Recomputes the solve counters of the teams, all of them by default, from their puzzle activities."""
+
+        if teams is None:
+            teams = Team.objects.all()
+
+        def count(activities: models.QuerySet) -> Coalesce:
+            return Coalesce(Subquery(activities.order_by().values("team").annotate(c=Count("pk")).values("c")),
+                            Value(0))
+
+        verified = md.TeamPuzzleActivity.objects.filter(team=OuterRef("pk"), verification_photo__approved=True)
+        solved = verified.filter(puzzle__enabled=True).exclude(puzzle_completed_at=None)
+        main = solved.filter(puzzle__stream__enabled=True, puzzle__stream__default=True)
+        last = md.TeamPuzzleActivity.objects.filter(team=OuterRef("pk")).exclude(puzzle_completed_at=None) \
+            .order_by("-puzzle_completed_at").values("puzzle_completed_at")[:1]
+
+        per_stream = md.TeamPuzzleActivity.objects \
+            .filter(team__in=teams, verification_photo__approved=True, puzzle__enabled=True) \
+            .exclude(puzzle_completed_at=None).order_by().values("team", "puzzle__stream") \
+            .annotate(n=Count("pk"), last=models.Max("puzzle_completed_at"))
+
+        with transaction.atomic():
+            teams.update(scav_verified_solves=count(verified), scav_main_solves=count(main),
+                         scav_last_solve_at=Subquery(last))
+            md.TeamStreamProgress.objects.filter(team__in=teams).delete()
+            md.TeamStreamProgress.objects.bulk_create([
+                md.TeamStreamProgress(team_id=row["team"], stream_id=row["puzzle__stream"],
+                                      verified_solves=row["n"], last_solve_at=row["last"])
+                for row in per_stream])
+
+    def render_scav_tree(self) -> dict:
+        """The team's progress tree, re-rendering only the streams that changed since it was cached."""
+
+        return render_tree(self)
 
     @property
     def active_branches(self):
-        activities = md.TeamPuzzleActivity.objects.filter(team=self).order_by("puzzle__stream__name") \
-                       .select_related("puzzle", "puzzle__stream")
-        branches = []
-        for a in activities:
-            found = False
-            for a2 in branches:
-                if a.puzzle.stream == a2.puzzle.stream:
-                    found = True
-            if a.puzzle.stream.enabled and not found:
-                branches += [a]
-        return branches  # This returns puzzle activities because Django templates can't call functions
+        # This returns puzzle activities because Django templates can't call functions
         # and the activities are the only model that has both team and puzzle info
+        return self.scavenger_snapshot().active_branches
 
     @property
     def to_dict(self):
         """Get the dict representation of the team."""
         return {
-            "team_id": self.group.id,
+            "team_id": self.group_id,
             "team_name": self.display_name,
             "coin_amount": self.coin_amount,
             "color_number": self.color,
             "color_code": self.color_code
         }
 
+    @classmethod
+    def serialize_many(cls, teams: Optional[models.QuerySet] = None, fields: Optional[Iterable[str]] = None,
+                       columnar: bool = False):
+        """
+        The to_dict of each of the teams, all of them by default, in the queryset's order, from one values_list query.
+
+        fields limits the keys to some of SERIALIZED_FIELDS. With columnar the result is a dict of a list per field
+        instead of a list of dicts, which is smaller to send to the scoreboard.
+        """
+
+        if teams is None:
+            teams = cls.objects.all()
+        fields = list(fields) if fields is not None else list(cls.SERIALIZED_FIELDS)
+        unknown = [f for f in fields if f not in cls.SERIALIZED_FIELDS]
+        if unknown:
+            raise ValueError(f"Teams cannot be serialized with {', '.join(unknown)}")
+
+        columns = list(dict.fromkeys(cls.SERIALIZED_FIELDS[f] for f in fields))
+        positions = [columns.index(cls.SERIALIZED_FIELDS[f]) for f in fields]
+        color_code = fields.index("color_code") if "color_code" in fields else None
+        rows = []
+        for row in teams.values_list(*columns):
+            values = [row[p] for p in positions]
+            if color_code is not None:
+                values[color_code] = Team._color_code(values[color_code])
+            rows.append(values)
+        if columnar:
+            return {field: [row[i] for row in rows] for i, field in enumerate(fields)}
+        return [dict(zip(fields, row)) for row in rows]
+
+    @staticmethod
+    def _color_code(color: Optional[int]) -> Optional[str]:
+        if color is not None:
+            return "#{:06x}".format(color)
+        else:
+            return None
+
     @property
     def color_code(self):
         """The hex color code string of the team's color."""
-        if self.color is not None:
-            return "#{:06x}".format(self.color)
-        else:
-            return None
+        return Team._color_code(self.color)
 
     @property
     def active_puzzles(self) -> List:
-        result = []
-        query = md.TeamPuzzleActivity.objects.select_related("puzzle") \
-                  .filter(team=self, puzzle_completed_at=None, puzzle__stream__locked=False) \
-                  .order_by("puzzle__order")
-        for a in query:
-            result += [a.puzzle]
-        return result
+        return self.scavenger_snapshot().active_puzzles
 
     @property
     def completed_puzzles(self) -> List:
-        result = []
-        query = md.TeamPuzzleActivity.objects.select_related("puzzle") \
-                  .filter(team=self).exclude(puzzle_completed_at=None).order_by("puzzle__order")
-        for a in query:
-            result += [a.puzzle]
-        return result
+        return self.scavenger_snapshot().completed_puzzles
 
     @property
     def verified_puzzles(self) -> List:
-        result = []
-        query = md.TeamPuzzleActivity.objects.select_related("puzzle", "verification_photo") \
-                  .filter(team=self, verification_photo__approved=True).order_by("puzzle__order")
-        for a in query:
-            result += [a.puzzle]
-        return result
+        return self.scavenger_snapshot().verified_puzzles
 
     @property
     def completed_puzzles_awaiting_verification(self) -> List:
-        result = []
-        query = md.TeamPuzzleActivity.objects.select_related("puzzle", "verification_photo") \
-                  .filter(team=self, verification_photo__approved=False).order_by("puzzle__order")
-        for a in query:
-            result += [a.puzzle]
-        return result
+        return self.scavenger_snapshot().completed_puzzles_awaiting_verification
 
     @property
     def all_puzzles(self) -> List:
-        return [tpa.puzzle for tpa in self.puzzle_activities]
+        return self.scavenger_snapshot().all_puzzles
 
     @property
     def _puzzle_activities_qs(self) -> models.QuerySet:
@@ -197,33 +395,28 @@ class Team(models.Model):
 
     @property
     def puzzle_activities(self) -> List:
-        return list(self._puzzle_activities_qs)
+        return self.scavenger_snapshot().activities
 
     @property
     def completed_puzzles_requiring_photo_upload(self) -> List:
-        result = []
-        query = md.TeamPuzzleActivity.objects.select_related("puzzle").filter(team=self, verification_photo=None) \
-                  .exclude(puzzle_completed_at=None).order_by("puzzle__order")
-        for a in query:
-            result += [a.puzzle]
-        return result
+        return self.scavenger_snapshot().completed_puzzles_requiring_photo_upload
 
     # @property
     # def latest_puzzle_activities(self) -> List[TeamPuzzleActivity]:
 
+    def is_scavenger_locked(self, stream_id: Optional[int] = None, at: Optional[datetime.datetime] = None) -> bool:
+        """Whether the team is locked out at the time, now by default, everywhere or in the given stream."""
+
+        if at is None:
+            at = timezone.now()
+        if md.LockoutPeriod.is_locked(stream_id, at):
+            return True
+        # An expired lockout is left in place, it stops applying once it has passed
+        return self.scavenger_locked_out_until > int(at.timestamp())
+
     @property
     def scavenger_locked(self) -> bool:
-        now = int(timezone.now().timestamp())
-        for period in md.LockoutPeriod.objects.filter(branch=None):
-            if int(period.start.timestamp()) <= now and int(period.end.timestamp()) >= now:
-                return True
-        if self.scavenger_locked_out_until == 0:
-            return False
-        if self.scavenger_locked_out_until <= now:
-            self.scavenger_locked_out_until = 0
-            self.save()
-            return False
-        return True
+        return self.is_scavenger_locked()
 
     @property
     def scavenger_locked_datetime(self) -> str:
@@ -250,16 +443,14 @@ class Team(models.Model):
     @property
     def scavenger_enabled(self) -> bool:
         """Returns a bool if scav is enabled for the team."""
-        return md.BooleanSetting.objects.get_or_create(
-            id="SCAVENGER_ENABLED")[0].value and self.scavenger_enabled_for_team and \
+        return site_settings.SCAVENGER_ENABLED.get() and self.scavenger_enabled_for_team and \
             self.scavenger_team and not self.scavenger_locked
 
     @property
     def trade_up_enabled(self) -> bool:
         """Returns a bool if trade up is enabled for the team."""
 
-        return md.BooleanSetting.objects.get_or_create(
-            id="TRADE_UP_ENABLED")[0].value and self.trade_up_enabled_for_team and self.trade_up_team
+        return site_settings.TRADE_UP_ENABLED.get() and self.trade_up_enabled_for_team and self.trade_up_team
 
     def enable_scavenger_for_team(self) -> None:
 
@@ -279,49 +470,104 @@ class Team(models.Model):
         self.trade_up_enabled_for_team = False
         self.save()
 
+    # Values of the scavenger fields for a team that has not started
+    SCAVENGER_RESET_VALUES = {
+        "scavenger_finished": False,
+        "scavenger_locked_out_until": 0,
+        "invalidate_tree": True,
+        "tree_cache": "",
+        "tree_dirty_streams": "",
+        "scav_verified_solves": 0,
+        "scav_main_solves": 0,
+        "scav_last_solve_at": None,
+    }
+
     def reset_scavenger_progress(self) -> None:
         """Reset the team's current scavenger question to the first enabled question."""
 
-        # Eliminate all progress
-        md.TeamPuzzleActivity.objects.filter(team=self.id).delete()
+        Team.reset_all_scavenger_progress(Team.objects.filter(pk=self.pk))
+        for field, value in Team.SCAVENGER_RESET_VALUES.items():
+            setattr(self, field, value)
+        self._clear_scavenger_snapshot()
 
-        # Unlock all questions
-        streams = md.PuzzleStream.objects.filter(enabled=True, default=True)
+    @staticmethod
+    def reset_all_scavenger_progress(teams: Optional[models.QuerySet] = None) -> None:
+        """
+        Resets the teams, all of them by default, to the first enabled puzzle of each default stream.
 
-        for s in streams:
-            puz = s.first_enabled_puzzle
+        Runs as one transaction of a few statements however many teams there are: the activities and stream
+        progress are deleted, the first activities created with one insert and the teams reset with one update.
+        """
 
-            if puz:
-                pa = md.TeamPuzzleActivity(team=self, puzzle=puz)
+        if teams is None:
+            teams = Team.objects.all()
+        first_ids = md.PuzzleStream.default_first_puzzle_ids()
 
-                pa.save()
+        # Buffered guesses refer to the activities about to be deleted
+        md.PuzzleGuess.flush()
+        with transaction.atomic():
+            team_ids = list(teams.values_list("pk", flat=True))
+            md.TeamPuzzleActivity.objects.filter(team__in=team_ids).delete()
+            md.TeamStreamProgress.objects.filter(team__in=team_ids).delete()
+            md.TeamPuzzleActivity.unlock((t, p) for t in team_ids for p in first_ids)
+            Team.objects.filter(pk__in=team_ids).update(**Team.SCAVENGER_RESET_VALUES)
 
-        self.scavenger_finished = False
-        self.scavenger_locked_out_until = 0
-        self.invalidate_tree = True
-        self.save()
+        logger.info(f"Reset the scavenger progress of {len(team_ids)} teams")
 
         # If hints are added they also need to be reset here
 
+    @staticmethod
+    def _scavenger_puzzles() -> models.QuerySet:
+        """The puzzles a team has to have verified to finish scavenger."""
+
+        return md.Puzzle.objects.filter(enabled=True, stream__enabled=True)
+
+    @staticmethod
+    def _finished_activities() -> models.QuerySet:
+        """Completed and verified activities on the puzzles needed to finish scavenger."""
+
+        return md.TeamPuzzleActivity.objects \
+            .filter(puzzle__enabled=True, puzzle__stream__enabled=True) \
+            .exclude(puzzle_completed_at=None) \
+            .filter(Q(verification_photo__approved=True) | Q(puzzle__require_photo_upload=False))
+
     def check_if_finished_scavenger(self) -> bool:
+        """Whether the team has verified every enabled puzzle, counted with one aggregate query."""
+
         if self.scavenger_finished:
             return True
 
-        all_streams = md.PuzzleStream.objects.filter(enabled=True)
-        for stream in all_streams:
-            all_stream_puzzles = stream.all_enabled_puzzles
-            for puz in all_stream_puzzles:
-                try:
-                    activity = md.TeamPuzzleActivity.objects.get(team=self.id, puzzle=puz.id)
-                    if not activity.is_verified or not activity.is_completed:
-                        return False
-                except md.TeamPuzzleActivity.DoesNotExist:
-                    return False
+        counts = Team._scavenger_puzzles().aggregate(
+            total=Count("pk"),
+            done=Count("pk", filter=Q(pk__in=Team._finished_activities().filter(team=self.pk).values("puzzle"))))
+        if counts["done"] < counts["total"]:
+            return False
 
         self.scavenger_finished = True
-        self.save()
+        self.save(update_fields=["scavenger_finished"])
         return True
 
+    @staticmethod
+    def check_all_finished_scavenger(teams: Optional[models.QuerySet] = None) -> int:
+        """
+        Marks the teams, all of them by default, that have verified every enabled puzzle as finished.
+
+        Returns the number of teams newly finished, found with one count and one update.
+        """
+
+        if teams is None:
+            teams = Team.objects.all()
+
+        total = Team._scavenger_puzzles().count()
+        done = Team._finished_activities().filter(team=OuterRef("pk")).order_by().values("team") \
+            .annotate(c=Count("pk")).values("c")
+        finished = teams.filter(scavenger_finished=False) \
+            .annotate(done=Coalesce(Subquery(done), Value(0))).filter(done__gte=total)
+        num_finished = Team.objects.filter(pk__in=finished.values("pk")).update(scavenger_finished=True)
+
+        logger.info(f"{num_finished} more teams finished scavenger")
+        return num_finished
+
     def refresh_scavenger_progress(self) -> None:
         return
         """Moves team along if verified on a puzzle or a puzzle has been disabled."""
@@ -338,16 +584,11 @@ class Team(models.Model):
             if (act.is_verified and act.is_completed) or not act.puzzle.enabled:
                 if act.puzzle.stream_branch is not None or act.puzzle.stream_puzzle is not None:
                     if act.puzzle.stream_puzzle is not None:
-                        try:
-                            md.TeamPuzzleActivity(team=self, puzzle=act.puzzle.stream_puzzle).save()
-                        except Exception:
-                            pass  # Activity already exists
+                        md.TeamPuzzleActivity.unlock([(self.pk, act.puzzle.stream_puzzle_id)])
                     if act.puzzle.stream_branch is not None:
-                        next_puz = act.puzzle.stream_branch.first_enabled_puzzle
-                        try:
-                            md.TeamPuzzleActivity(team=self, puzzle=next_puz).save()
-                        except Exception:
-                            pass  # Activity already exists
+                        next_id = md.PuzzleStream.order_of(act.puzzle.stream_branch_id).first_id
+                        if next_id is not None:
+                            md.TeamPuzzleActivity.unlock([(self.pk, next_id)])
                 max_order = act.puzzle.order
                 for a2 in activities:
                     if a2.puzzle.stream == act.puzzle.stream and a2.puzzle.order > max_order:
@@ -364,10 +605,7 @@ class Team(models.Model):
                     if self.check_if_finished_scavenger():
                         return
                     continue
-                try:
-                    md.TeamPuzzleActivity(team=self, puzzle=next_puz).save()
-                except Exception:
-                    pass  # Activity already exists
+                md.TeamPuzzleActivity.unlock([(self.pk, next_puz.pk)])
                 if not act.is_completed and not act.puzzle.enabled:
                     act.delete()
 
@@ -391,3 +629,32 @@ class Team(models.Model):
         self.locked_out_until = until
         self.save()
         raise True
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def _forget_member_teams(sender, instance, action, reverse, pk_set, **kwargs) -> None:
+    if not reverse:
+        # The groups of one user changed
+        if action in ("post_add", "post_remove", "post_clear"):
+            _forget_user_teams([instance.pk])
+    elif action == "pre_clear":
+        # The members of a group are about to be removed, they can't be found afterwards
+        instance._cleared_user_ids = list(instance.user_set.values_list("pk", flat=True))
+    elif action == "post_clear":
+        _forget_user_teams(getattr(instance, "_cleared_user_ids", []))
+    elif action in ("post_add", "post_remove"):
+        _forget_user_teams(pk_set)
+
+
+@receiver([post_save, post_delete], sender=Team)
+def _forget_team_members(sender, instance, **kwargs) -> None:
+    # A team's group never changes once it is created
+    if not kwargs.get("created", True):
+        return
+    _forget_user_teams(User.groups.through.objects.filter(group_id=instance.pk).values_list("user_id", flat=True))
+
+
+@receiver(post_delete, sender=User)
+def _forget_deleted_user_team(sender, instance, **kwargs) -> None:
+    # Deleting a user removes their memberships without an m2m_changed signal
+    _forget_user_teams([instance.pk])
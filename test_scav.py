@@ -1,6 +1,25 @@
 from django.test import TestCase
 from .models import Puzzle, TeamPuzzleActivity, Team, PuzzleStream, PuzzleGuess, VerificationPhoto, initialize_scav
-from django.contrib.auth.models import Group
+from .models import BooleanSetting, CoinStandings, CoinTransaction, LockoutPeriod, PuzzleGuessStats, Setting, TeamRoom
+from .models import MagicLink, ScavengerLockedOut
+from .models import DiscordChannel, DiscordOutboxMessage, QRCode, SiteImage
+from .discord_models import OUTBOX_MAX_ATTEMPTS
+from . import site_settings
+from .buffering import WriteBehindBuffer
+from .print_sheets import SheetLayout, write_pdf
+from .teams_models import _user_team_key
+from django.contrib.auth.models import AnonymousUser, Group, User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db.models import F
+from django.utils import timezone
+from io import BytesIO
+from PIL import Image, PdfParser
+import datetime
+import os
+import tempfile
+import threading
+from unittest import mock
 
 
 class ScavUnorderedTests(TestCase):
@@ -27,6 +46,10 @@ class ScavUnorderedTests(TestCase):
         self.team2 = Team.objects.create(group=group2, display_name="T2")
         initialize_scav()
 
+    def tearDown(self):
+        # Buffered guesses would outlive the test's rollback
+        PuzzleGuess.flush()
+
     def test_initialize(self):
         activities = TeamPuzzleActivity.objects.all()
         self.assertEqual(len(activities), 2)
@@ -56,6 +79,8 @@ class ScavUnorderedTests(TestCase):
 
         self.assertFalse(self.test11.check_team_guess(self.team1, 'a'*150)[0])
         self.assertFalse(self.test11.check_team_guess(self.team1, 'test')[0])
+        self.assertEqual(PuzzleGuess.objects.count(), 0)
+        PuzzleGuess.flush()
         guess = PuzzleGuess.objects.all()
         self.assertEqual(len(guess), 1)  # Over 100 chars doesn't fit in model so it doesn't count
         guess = guess.first()
@@ -99,3 +124,471 @@ class ScavUnorderedTests(TestCase):
         self.assertNotEqual(TeamPuzzleActivity.objects.filter(team=self.team1, puzzle=self.test41).first(), None)
 
         self.team1 = Team.objects.filter(group=Group.objects.filter(name="T1").first()).first()
+
+    def test_guess_query_count(self):
+        LockoutPeriod.is_locked()  # Build the lockout intervals cache
+        # Savepoint, locked activity lookup and release, the guess is buffered
+        with self.assertNumQueries(3):
+            self.assertFalse(self.test11.check_team_guess(self.team2, "wrong")[0])
+        # Completing also updates the activity, flags the team's tree and looks up the updates channels
+        with self.assertNumQueries(6):
+            self.assertEqual(self.test11.check_team_guess(self.team2, "test2"), (True, False, None, True))
+
+    def test_answer_index(self):
+        index = Puzzle(answer="abcd,EFGH,abcd").answer_index
+        self.assertEqual(index.masks, {"abcd": 0b101, "efgh": 0b010})
+        self.assertEqual(index.full_mask, 0b111)
+
+        activity = TeamPuzzleActivity(team=self.team1, puzzle=self.test41)
+        self.assertEqual(activity._apply_answer("EFGH"), (True, False))
+        self.assertEqual(activity._apply_answer("efgh"), (False, False))
+        self.assertEqual(activity._apply_answer("abcd"), (True, True))
+        self.assertEqual(activity.completed_answers, ["abcd", "efgh"])
+
+    def test_stream_order_cache(self):
+        self.assertEqual(PuzzleStream.order_of(self.test1.id).first_id, self.test11.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.test11.next_enabled_puzzle_id, self.test12.id)
+            self.assertEqual(self.test21.next_enabled_puzzle_id, self.test22.id)
+            self.assertFalse(self.test11.last_puzzle_in_stream)
+            self.assertTrue(self.test13.last_puzzle_in_stream)
+
+        # Saving a puzzle rebuilds the order
+        self.test13.enabled = False
+        self.test13.save()
+        self.assertIsNone(self.test12.next_enabled_puzzle_id)
+        self.test13.enabled = True
+        self.test13.save()
+        self.assertEqual(self.test12.next_enabled_puzzle_id, self.test13.id)
+
+    def test_scavenger_snapshot(self):
+        team = Team.objects.get(pk=self.team1.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(team.active_puzzles, [self.test11])
+            self.assertEqual(team.completed_puzzles, [])
+            self.assertEqual(team.completed_puzzles_requiring_photo_upload, [])
+            self.assertEqual(team.num_main_clues_finished, 0)
+            self.assertEqual(team.last_puzzle_timestamp, "N/A")
+            self.assertEqual([a.puzzle for a in team.active_branches], [self.test11])
+
+    def test_solve_counters(self):
+        stale = Team.objects.get(pk=self.team2.pk)
+        self.test11.check_team_guess(self.team2, "test2", bypass=True)
+        Team.objects.filter(pk=self.team2.pk).update(free_hints=F("free_hints") + 1)
+        # A full save of a team loaded before the solve leaves the counters kept by updates as they are
+        stale.scavenger_lock(5)
+        team = Team.objects.get(pk=self.team2.pk)
+        self.assertEqual((team.num_clues_finished, team.num_main_clues_finished), (1, 1))
+        self.assertEqual(team.free_hints, 1)
+        self.assertNotEqual(team.last_puzzle_timestamp, "N/A")
+        self.assertEqual(TeamPuzzleActivity.objects.get(team=team, puzzle=self.test11).num_clues_finished, 1)
+        self.assertEqual(Team.leaderboard().first(), team)
+
+        Team.rebuild_solve_counters()
+        team.refresh_from_db()
+        self.assertEqual((team.num_clues_finished, team.num_main_clues_finished), (1, 1))
+
+    def test_approve_many(self):
+        photos = []
+        for team in (self.team1, self.team2):
+            self.test11.check_team_guess(team, "test2")
+            photo = VerificationPhoto.objects.create()
+            TeamPuzzleActivity.objects.filter(team=team, puzzle=self.test11).update(verification_photo=photo)
+            photos.append(photo.pk)
+
+        self.assertEqual(VerificationPhoto.approve_many(VerificationPhoto.objects.filter(pk__in=photos)), 2)
+        self.assertEqual(VerificationPhoto.approve_many(VerificationPhoto.objects.filter(pk__in=photos)), 0)
+        for team in (self.team1, self.team2):
+            self.assertTrue(TeamPuzzleActivity.objects.filter(team=team, puzzle=self.test12).exists())
+            self.assertTrue(TeamPuzzleActivity.objects.filter(team=team, puzzle=self.test21).exists())
+            self.assertEqual(Team.objects.get(pk=team.pk).num_main_clues_finished, 1)
+
+    def test_lockout_periods(self):
+        now = timezone.now()
+        LockoutPeriod.objects.create(start=now - datetime.timedelta(minutes=5), end=now + datetime.timedelta(minutes=5),
+                                     branch=self.test2)
+        self.assertTrue(LockoutPeriod.is_locked(self.test2.id))
+        self.assertFalse(LockoutPeriod.is_locked(self.test1.id))
+        self.assertFalse(self.team1.scavenger_locked)
+        self.assertTrue(self.team1.is_scavenger_locked(self.test2.id))
+        self.assertFalse(self.team1.is_scavenger_locked(self.test2.id, now + datetime.timedelta(minutes=10)))
+        # Told apart from a wrong answer, and not logged as a guess
+        with self.assertRaises(ScavengerLockedOut):
+            self.test21.check_team_guess(self.team1, "test")
+        PuzzleGuess.flush()
+        self.assertFalse(PuzzleGuess.objects.exists())
+
+        LockoutPeriod.objects.create(start=now - datetime.timedelta(minutes=1), end=now + datetime.timedelta(minutes=1))
+        self.assertTrue(self.team1.scavenger_locked)
+
+        # Deleting invalidates the cached intervals, which outlive the test's rollback
+        LockoutPeriod.objects.all().delete()
+        self.assertFalse(self.team1.scavenger_locked)
+
+    def test_scav_tree(self):
+        team = Team.objects.get(pk=self.team2.pk)
+        tree = team.render_scav_tree()
+        self.assertEqual([n["status"] for n in tree["streams"][str(self.test1.id)]["nodes"]], ["active"])
+        with self.assertNumQueries(1):
+            self.assertEqual(team.render_scav_tree(), tree)
+
+        self.test11.check_team_guess(team, "test2")
+        photo = VerificationPhoto.objects.create()
+        TeamPuzzleActivity.objects.filter(team=team, puzzle=self.test11).update(verification_photo=photo)
+        photo.approve()
+        team.refresh_from_db()
+        self.assertTrue(team.invalidate_tree)
+
+        # Team row, the activities of the dirty streams and the update
+        with self.assertNumQueries(3):
+            tree = team.render_scav_tree()
+        self.assertEqual([n["status"] for n in tree["streams"][str(self.test1.id)]["nodes"]], ["verified", "active"])
+        self.assertEqual([n["id"] for n in tree["streams"][str(self.test2.id)]["nodes"]], [self.test21.id])
+        team.refresh_from_db()
+        self.assertEqual((team.tree_dirty_streams, team.invalidate_tree), ("", False))
+
+    def test_guess_stats(self):
+        TeamPuzzleActivity.objects.filter(team=self.team2, puzzle=self.test11) \
+            .update(puzzle_unlocked_at=timezone.now() - datetime.timedelta(minutes=50))
+        # The answer entered again once solved is neither wrong nor another solve
+        for guess in ("wrong", "WRONG", "other", "test2", "Test2"):
+            self.test11.check_team_guess(self.team2, guess)
+        PuzzleGuess.flush()
+
+        stats = PuzzleGuessStats.objects.get(puzzle=self.test11)
+        self.assertEqual((stats.guesses, stats.wrong_guesses, stats.solves), (5, 3, 1))
+        self.assertEqual(stats.top_wrong_answers, [("wrong", 2), ("other", 1)])
+        self.assertEqual(stats.solve_time_percentiles(), {0.5: 3600, 0.9: 3600})
+
+        # Saving the activity, as uploading a photo does, does not move when it was unlocked
+        TeamPuzzleActivity.objects.get(team=self.team2, puzzle=self.test11).save()
+        PuzzleGuessStats.rebuild()
+        stats = PuzzleGuessStats.objects.get(puzzle=self.test11)
+        self.assertEqual((stats.guesses, stats.wrong_guesses, stats.solves), (5, 3, 1))
+        self.assertEqual(stats.top_wrong_answers, [("wrong", 2), ("other", 1)])
+        self.assertEqual(stats.solve_time_percentiles(), {0.5: 3600, 0.9: 3600})
+
+    def test_check_finished_scavenger(self):
+        team = Team.objects.get(pk=self.team1.pk)
+        with self.assertNumQueries(1):
+            self.assertFalse(team.check_if_finished_scavenger())
+        self.assertEqual(Team.check_all_finished_scavenger(), 0)
+
+        for puzzle in Puzzle.objects.filter(enabled=True, stream__enabled=True):
+            photo = VerificationPhoto.objects.create(approved=True)
+            TeamPuzzleActivity.objects.update_or_create(team=team, puzzle=puzzle, defaults={
+                "puzzle_completed_at": timezone.now(), "verification_photo": photo})
+        self.assertEqual(Team.check_all_finished_scavenger(), 1)
+        team.refresh_from_db()
+        self.assertTrue(team.scavenger_finished)
+        self.assertFalse(Team.objects.get(pk=self.team2.pk).check_if_finished_scavenger())
+
+    def test_reset_all_scavenger_progress(self):
+        self.test11.check_team_guess(self.team1, "test2", bypass=True)
+        Team.reset_all_scavenger_progress()
+        self.assertEqual(sorted(TeamPuzzleActivity.objects.values_list("puzzle", flat=True)),
+                         [self.test11.id, self.test11.id])
+        team = Team.objects.get(pk=self.team1.pk)
+        self.assertEqual((team.num_clues_finished, team.last_puzzle_timestamp), (0, "N/A"))
+        self.assertTrue(team.invalidate_tree)
+
+    def test_unlock(self):
+        grants = [(self.team1.pk, self.test11.pk), (self.team1.pk, self.test12.pk), (self.team2.pk, self.test12.pk)]
+        self.assertEqual(TeamPuzzleActivity.unlock(grants), set(grants[1:]))
+        with self.assertNumQueries(1):
+            self.assertEqual(TeamPuzzleActivity.unlock(grants), set())
+        self.assertEqual(TeamPuzzleActivity.objects.filter(puzzle=self.test12).count(), 2)
+
+    def test_team_from_user(self):
+        user = User.objects.create(username="frosh")
+        self.assertIsNone(Team.from_user(user))
+        with self.assertNumQueries(0):
+            self.assertIsNone(Team.from_user(user))
+
+        # Membership changes clear the cached team
+        user.groups.add(self.team1.group)
+        self.assertEqual(Team.from_user(user), self.team1)
+        self.assertEqual(Team.for_users([user.pk]), {user.pk: self.team1})
+        self.team1.group.user_set.clear()
+        self.assertIsNone(Team.from_user(user))
+
+        # A team cached by another process before the change commits is forgotten on commit
+        with self.captureOnCommitCallbacks(execute=True):
+            user.groups.add(self.team2.group)
+            cache.set(_user_team_key(user.pk), 0)
+        self.assertEqual(Team.from_user(user), self.team2)
+        user.delete()
+
+        # Not the teams without members
+        with self.assertNumQueries(0):
+            self.assertIsNone(Team.from_user(AnonymousUser()))
+
+    def test_team_rooms(self):
+        today = datetime.date.today()
+        TeamRoom.objects.create(team=self.team1, date=today, room="BA1130")
+        TeamRoom.objects.create(team=self.team1, date=today + datetime.timedelta(days=1), room="BA1160")
+        self.assertEqual(self.team1.room, "BA1130")
+        with self.assertNumQueries(1):
+            self.assertEqual(Team.rooms_on(), {self.team1.pk: "BA1130", self.team2.pk: None})
+        self.assertEqual(Team.rooms_on(today + datetime.timedelta(days=1))[self.team1.pk], "BA1160")
+
+    def test_coin_ledger(self):
+        stale = Team.objects.get(pk=self.team1.pk)
+        CoinTransaction.award(self.team1.pk, 10, "Trade up")
+        with self.assertNumQueries(4):
+            CoinTransaction.award_many({self.team1.pk: 5, self.team2.pk: -3, 0: 0})
+        # A full save of a team loaded before the awards applies its own change rather than overwriting them
+        stale.coin_amount += 2
+        stale.save()
+        self.assertEqual(Team.objects.get(pk=self.team1.pk).coin_amount, 17)
+        self.assertEqual(Team.objects.get(pk=self.team2.pk).coin_amount, -3)
+        self.assertEqual(CoinTransaction.reconcile(), {})
+
+        # Only the loaded fields are written back, without loading the deferred ones one at a time
+        partial = Team.objects.only("pk", "display_name").get(pk=self.team1.pk)
+        partial.display_name = "T1 renamed"
+        with self.assertNumQueries(3):
+            partial.save()
+        partial.refresh_from_db(fields=["coin_amount"])
+        self.assertEqual(partial.coin_amount, 17)
+
+        Team.objects.filter(pk=self.team2.pk).update(coin_amount=100)
+        self.assertEqual(CoinTransaction.reconcile(Team.objects.filter(pk=self.team1.pk), fix=True), {})
+        self.assertEqual(CoinTransaction.reconcile(fix=True), {self.team2.pk: (100, -3)})
+        self.assertEqual(Team.objects.get(pk=self.team2.pk).coin_amount, -3)
+
+    def test_coin_standings(self):
+        CoinStandings.invalidate()
+        with self.assertNumQueries(1):
+            standings = CoinStandings.current()
+        self.assertEqual(standings.rank_of(self.team1.pk), 1)
+        self.assertEqual(standings.rank_of(self.team2.pk), 1)
+        with self.assertNumQueries(0):
+            CoinStandings.current()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            CoinTransaction.award(self.team2.pk, 5)
+        with self.assertNumQueries(0):
+            standings = CoinStandings.current()
+        self.assertEqual(standings.top(1), [dict(Team.objects.get(pk=self.team2.pk).to_dict, rank=1)])
+        self.assertEqual(standings.rank_of(self.team1.pk), 2)
+        CoinStandings.invalidate()
+
+    def test_site_settings(self):
+        # The settings read here would otherwise outlive the test's rollback
+        self.addCleanup(site_settings._settings.invalidate)
+        site_settings.seed_settings()
+        self.assertTrue(site_settings.SCAVENGER_ENABLED.get())
+        with self.assertNumQueries(0):
+            self.assertEqual(site_settings.FROSH_CHECKIN_REQ.get(), ["waiver"])
+            self.assertEqual(site_settings.FACIL_SHIFT_CUTOFF.get(), 259200)
+        # Changing the list read does not change the setting
+        site_settings.FROSH_CHECKIN_REQ.get().append("paid")
+        self.assertEqual(site_settings.FROSH_CHECKIN_REQ.get(), ["waiver"])
+
+        setting = BooleanSetting.objects.get(id="SCAVENGER_ENABLED")
+        setting.value = False
+        setting.save()
+        self.assertFalse(site_settings.SCAVENGER_ENABLED.get())
+        self.assertFalse(Team.objects.get(pk=self.team1.pk).scavenger_enabled)
+
+        Setting.objects.filter(id="Facil Shift Cutoff").delete()
+        self.assertEqual(site_settings.FACIL_SHIFT_CUTOFF.get(), 259200)
+        Setting.objects.create(id="Facil Shift Cutoff", value="soon")
+        self.assertEqual(site_settings.FACIL_SHIFT_CUTOFF.get(), 259200)
+
+    def test_serialize_many(self):
+        teams = Team.objects.order_by("display_name")
+        with self.assertNumQueries(1):
+            serialized = Team.serialize_many(teams)
+        self.assertEqual(serialized, [team.to_dict for team in teams])
+        self.assertEqual(Team.serialize_many(teams, ["team_name", "color_code"], columnar=True),
+                         {"team_name": ["T1", "T2"], "color_code": [None, None]})
+        with self.assertRaises(ValueError):
+            Team.serialize_many(teams, ["group"])
+
+    def test_guess_to_deleted_activity(self):
+        self.test11.check_team_guess(self.team1, "wrong")
+        TeamPuzzleActivity.objects.filter(team=self.team1).delete()
+        with self.assertLogs("common_models.scav_models", "WARNING"):
+            self.assertEqual(PuzzleGuess.flush(), 0)
+        self.assertFalse(PuzzleGuess.objects.exists())
+
+    def test_print_sheets(self):
+        image = BytesIO()
+        Image.new("RGB", (64, 64), (0, 0, 0)).save(image, "PNG")
+        layout = SheetLayout(columns=2, rows=2, dpi=50)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "sheets.pdf")
+            progress = []
+            self.assertEqual(write_pdf(path, [image.getvalue()] * 9, layout, 1, progress.append), 3)
+            self.assertEqual(progress, [1, 2, 3])
+            self.assertEqual(len(PdfParser.PdfParser(path).pages), 3)
+            self.assertEqual(write_pdf(os.path.join(directory, "empty.pdf"), [], layout, 1), 0)
+
+    def test_magic_link_tokens(self):
+        user = User.objects.create(username="magic")
+        link = MagicLink.objects.create(user=user)
+        token = link.raw_token
+        self.assertIn(f"auth={token}", link.full_link("https://example.com"))
+        with self.assertNumQueries(1):
+            self.assertEqual(MagicLink.from_token(token), link)
+        self.assertIsNone(MagicLink.from_token(link.token))
+
+        # Only the digest is stored, a loaded link needs a new token for a new full link
+        loaded = MagicLink.objects.get(pk=link.pk)
+        with self.assertRaises(ValueError):
+            loaded.full_link("https://example.com")
+        reissued = loaded.reissue()
+        self.assertIsNone(MagicLink.from_token(token))
+        self.assertEqual(MagicLink.from_token(reissued), link)
+
+        MagicLink.objects.filter(pk=link.pk).update(expiry=timezone.now() - datetime.timedelta(minutes=1))
+        self.assertIsNone(MagicLink.from_token(reissued))
+
+    def test_sweep_expired_magic_links(self):
+        with tempfile.TemporaryDirectory() as media, self.settings(MEDIA_ROOT=media):
+            expired = MagicLink.objects.create(user=User.objects.create(username="expired"),
+                                               expiry=timezone.now() - datetime.timedelta(minutes=1))
+            expired.qr_code.save("QRCode.png", ContentFile(b"png"))
+            current = MagicLink.objects.create(user=User.objects.create(username="current"))
+            storage = expired.qr_code.storage
+            self.assertTrue(storage.exists(expired.qr_code.name))
+
+            self.assertEqual(MagicLink.sweep_expired(), 1)
+            self.assertEqual(list(MagicLink.objects.all()), [current])
+            self.assertFalse(storage.exists(expired.qr_code.name))
+
+    def test_discord_outbox(self):
+        first, second = (DiscordChannel.objects.create(id=i, type=0) for i in (1, 2))
+        for channel, content in ((first, "a1"), (first, "a2"), (second, "b1")):
+            channel.queue(content)
+        sent = []
+
+        def send(channel_id, content):
+            # Claimed before discord is called, so another dispatcher would leave them
+            claimed = DiscordOutboxMessage.objects.filter(
+                sent_at=None, next_attempt_at__gt=timezone.now() + datetime.timedelta(minutes=5))
+            self.assertTrue(claimed.filter(channel=channel_id).exists())
+            if channel_id == first.id and not sent:
+                raise ConnectionError("down")
+            sent.append((channel_id, content))
+
+        api = mock.Mock()
+        api.send_channel_message.side_effect = send
+        with mock.patch("common_models.discord_models.get_client", return_value=api):
+            self.assertEqual(DiscordOutboxMessage.dispatch_pending(), (1, 2))
+            retry = DiscordOutboxMessage.objects.get(content="a1")
+            self.assertEqual((retry.attempts, retry.last_error, retry.failed), (1, "down", False))
+
+            # The channel waiting on its retry does not hold back the others
+            second.queue("b2")
+            self.assertEqual(DiscordOutboxMessage.dispatch_pending(), (1, 0))
+
+            DiscordOutboxMessage.objects.filter(channel=first).update(next_attempt_at=timezone.now())
+            self.assertEqual(DiscordOutboxMessage.dispatch_pending(), (2, 0))
+            self.assertEqual(sent, [(2, "b1"), (2, "b2"), (1, "a1\na2")])
+            self.assertFalse(DiscordOutboxMessage.objects.filter(sent_at=None).exists())
+
+            # Given up on after the last attempt, the first channel failing again once nothing has been sent
+            first.queue("a3")
+            DiscordOutboxMessage.objects.filter(content="a3").update(attempts=OUTBOX_MAX_ATTEMPTS - 1)
+            sent.clear()
+            self.assertEqual(DiscordOutboxMessage.dispatch_pending(), (0, 1))
+            self.assertTrue(DiscordOutboxMessage.objects.get(content="a3").failed)
+            self.assertEqual(DiscordOutboxMessage.dispatch_pending(), (0, 0))
+
+    def _qr_code_image(self):
+        # The image in the middle of the puzzle QR codes
+        image = BytesIO()
+        Image.new("RGB", (16, 16), (255, 0, 0)).save(image, "PNG")
+        SiteImage.objects.create(name="QR Code Image", image=ContentFile(image.getvalue(), name="qr.png"))
+
+    def test_generate_qr_codes(self):
+        with tempfile.TemporaryDirectory() as media, self.settings(MEDIA_ROOT=media):
+            self._qr_code_image()
+            rendered = []
+            self.assertEqual(QRCode.generate_for_puzzles([self.test41, self.test21], workers=2,
+                                                         progress=lambda i, n: rendered.append((i, n))), 3)
+            self.assertEqual(rendered, [(1, 3), (2, 3), (3, 3)])
+            codes = QRCode.objects.filter(puzzle__in=[self.test41, self.test21])
+            # One per answer
+            self.assertEqual(sorted(codes.values_list("puzzle", flat=True)),
+                             sorted([self.test41.id, self.test41.id, self.test21.id]))
+            for code in codes:
+                with Image.open(code.qr_code.path) as im:
+                    self.assertEqual(im.format, "PNG")
+
+    def test_qr_code_digests(self):
+        with tempfile.TemporaryDirectory() as media, self.settings(MEDIA_ROOT=media):
+            self._qr_code_image()
+            puzzle = Puzzle.objects.get(pk=self.test41.pk)
+            self.assertEqual(QRCode.generate_for_puzzles([puzzle], workers=1), 2)
+            names = dict(QRCode.objects.filter(puzzle=self.test41).values_list("digest", "qr_code"))
+            # Nothing changed, nothing rendered
+            self.assertEqual(QRCode.generate_for_puzzles([puzzle], workers=1), 0)
+            self.assertEqual(dict(QRCode.objects.filter(puzzle=self.test41).values_list("digest", "qr_code")), names)
+
+            # Only the new answer is rendered, the code of the answer that is gone is deleted with its image
+            puzzle.answer = "abcd,ijkl"
+            puzzle.save()
+            self.assertEqual(QRCode.generate_for_puzzles([puzzle], workers=1), 1)
+            codes = dict(QRCode.objects.filter(puzzle=self.test41).values_list("digest", "qr_code"))
+            self.assertEqual(len(codes), 2)
+            kept = set(codes) & set(names)
+            self.assertEqual(len(kept), 1)
+            storage = QRCode._meta.get_field("qr_code").storage
+            for digest, name in names.items():
+                self.assertEqual(storage.exists(name), digest in kept)
+
+    def test_issue_magic_links(self):
+        with tempfile.TemporaryDirectory() as media, self.settings(MEDIA_ROOT=media):
+            users = User.objects.filter(username__startswith="link")
+            for i in range(3):
+                User.objects.create(username=f"link{i}", first_name="Link", last_name=str(i))
+            # Left without a QR code by an earlier run
+            unfinished = MagicLink.objects.create(user=users.get(username="link2"))
+
+            def interrupt(done, total):
+                raise KeyboardInterrupt
+
+            with self.assertRaises(KeyboardInterrupt):
+                MagicLink.issue_many(users, "https://example.com", workers=1, batch_size=2, progress=interrupt)
+            issued = dict(MagicLink.objects.exclude(qr_code="").values_list("user", "qr_code"))
+            self.assertEqual(len(issued), 2)
+
+            # Carries on where it stopped, the unfinished link getting a new token
+            self.assertEqual(MagicLink.issue_many(users, "https://example.com", workers=1, batch_size=2), 1)
+            self.assertEqual(MagicLink.issue_many(users, "https://example.com", workers=1, batch_size=2), 0)
+            links = MagicLink.objects.filter(user__in=users)
+            self.assertEqual(links.exclude(qr_code="").count(), 3)
+            self.assertEqual({u: q for u, q in links.values_list("user", "qr_code") if u in issued}, issued)
+            self.assertNotEqual(MagicLink.objects.get(pk=unfinished.pk).token, unfinished.token)
+
+    def test_write_behind_buffer(self):
+        def fail(rows):
+            raise ConnectionError("down")
+
+        flushed = threading.Event()
+        buffer = WriteBehindBuffer(PuzzleGuess, 2, 0.01, before_insert=fail)
+        with mock.patch.object(buffer, "flush_if_due", side_effect=flushed.set):
+            buffer.add(PuzzleGuess(value="timer"))
+            # Flushed by the timer without another row or a request
+            self.assertTrue(flushed.wait(5))
+            with buffer._lock:
+                buffer._rows.clear()
+
+        buffer = WriteBehindBuffer(PuzzleGuess, 2, 60, before_insert=fail)
+        guesses = [PuzzleGuess(value=str(i)) for i in range(3)]
+        buffer.add(guesses[0])
+        buffer.add(guesses[1])
+        with self.assertLogs("common_models.buffering", "ERROR"):
+            self.assertEqual(buffer.flush(), 0)
+        buffer.add(guesses[2])
+        # Put back for the next flush, without going over the buffer's size
+        with self.assertLogs("common_models.buffering", "ERROR") as logs:
+            self.assertEqual(buffer.flush(), 0)
+        self.assertIn("Dropping 1 buffered PuzzleGuess rows over the buffer's size", "\n".join(logs.output))
+        self.assertEqual(buffer._rows, guesses[1:])
+        buffer._timer.cancel()
+        buffer._rows.clear()